@@ -0,0 +1,141 @@
+from markov_football.markov import MarkovChain
+from markov_football.markov_football import (TeamState, _calculate_team_probs, calculate_markov_chain,
+                                             next_goal_probs, next_goal_cache)
+from markov_football.util import (evaluate_selection, create_next_goal_matrix, optmise_player_positions_in_parrallel,
+                                  hold_fixture, hold_week, fixtures)
+from markov_football.league import create_population, create_selections
+from collections import OrderedDict, Counter, defaultdict
+from typing import Callable, Dict
+import numpy as np
+import argparse
+import json
+import platform
+import statistics
+import sys
+import timeit
+
+# Times the hot paths on a synthetic league built from a fixed seed. run writes the seconds per call of each
+# benchmark to a JSON file; compare reads two such files and fails if any benchmark got slower than a threshold.
+
+
+def benchmarks(clubs: int, seed: int) -> Dict[str, Callable[[], object]]:
+    names = ['Club %d' % i for i in range(clubs)]
+    pool = create_population({'League': names}, rng=np.random.default_rng(seed))
+    selections_by_name = create_selections(clubs=names, pool=pool)
+    selections = list(selections_by_name.values())
+    selection_1, selection_2 = selections[:2]
+    transitions = (_calculate_team_probs(selection_1, selection_2) +
+                   _calculate_team_probs(selection_2, selection_1))
+    mc = calculate_markov_chain(selection_1=selection_1, selection_2=selection_2)
+    team_states = [TeamState.WITH_M]
+    first_week = next(iter(fixtures(names)))
+
+    def week():
+        counters = [Counter() for _ in range(6)]
+        hold_week(fixtures=first_week, selections_by_name=OrderedDict(selections_by_name),
+                  player_position_history=defaultdict(list), goals=counters[0], conceded_goals=counters[1],
+                  points=counters[2], wins=counters[3], losses=counters[4], draws=counters[5],
+                  rng=np.random.default_rng(seed))
+
+    return OrderedDict([
+        ('markov_chain_init', lambda: MarkovChain(transitions)),
+        ('calculate_markov_chain', lambda: calculate_markov_chain(selection_1=selection_1, selection_2=selection_2)),
+        ('next_goal_probs', lambda: next_goal_probs(mc=mc, team_states=team_states)),
+        ('chain_and_next_goal_probs', lambda: next_goal_probs(mc=calculate_markov_chain(selection_1=selection_1,
+                                                                                        selection_2=selection_2),
+                                                              team_states=team_states)),
+        ('evaluate_selection', lambda: list(evaluate_selection(selection=selection_1, reference_selections=selections,
+                                                               team_states=team_states))),
+        ('create_next_goal_matrix', lambda: create_next_goal_matrix(selections=selections, team_states=team_states)),
+        ('optimise_league', lambda: list(optmise_player_positions_in_parrallel(selections=selections,
+                                                                               team_states=team_states,
+                                                                               rng=np.random.default_rng(seed)))),
+        ('hold_fixture', lambda: hold_fixture(selection_1=selection_1, selection_2=selection_2,
+                                              rng=np.random.default_rng(seed))),
+        ('hold_week', week),
+    ])
+
+
+def time_call(function: Callable[[], object], repeats: int, warm_cache: bool = False) -> Dict[str, float]:
+    # As timeit does: enough calls per repeat to take about 0.2s, and the median and best of the repeats per call.
+    # One call first, so that lazy imports are not timed. Unless warm_cache, every call starts with an empty
+    # next_goal_cache, so that repeated calls do not just measure its hits.
+    function()
+    if not warm_cache:
+        timed = function
+
+        def function():
+            next_goal_cache.clear()
+            return timed()
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    seconds = [elapsed / number for elapsed in timer.repeat(repeat=repeats, number=number)]
+    return dict(median=statistics.median(seconds), best=min(seconds), number=number)
+
+
+def run(args):
+    results = OrderedDict()
+    for name, function in benchmarks(clubs=args.clubs, seed=args.seed).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = time_call(function, repeats=args.repeats, warm_cache=args.warm_cache)
+        print('%-26s %12.6fs  (best %.6fs, %d calls x %d)' % (name, results[name]['median'], results[name]['best'],
+                                                              results[name]['number'], args.repeats))
+
+    report = dict(clubs=args.clubs, seed=args.seed, repeats=args.repeats, warm_cache=args.warm_cache,
+                  python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                  results=results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+
+    if (baseline['clubs'], baseline['seed']) != (current['clubs'], current['seed']):
+        print('Warning: the runs used different leagues. clubs=%d/%d, seed=%d/%d' % (
+            baseline['clubs'], current['clubs'], baseline['seed'], current['seed']))
+
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print('%-26s %12.6fs  (new)' % (name, result['median']))
+            continue
+        ratio = result['median'] / baseline['results'][name]['median']
+        regressed = ratio > 1.0 + args.threshold
+        if regressed:
+            regressions.append(name)
+        print('%-26s %12.6fs -> %12.6fs  x%.2f%s' % (name, baseline['results'][name]['median'], result['median'],
+                                                      ratio, '  REGRESSION' if regressed else ''))
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Time every benchmark.')
+    run_parser.add_argument('--clubs', type=int, default=20, help='Number of clubs in the synthetic league.')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeats', type=int, default=5)
+    run_parser.add_argument('--only', nargs='*', default=None, help='Names of the benchmarks to run.')
+    run_parser.add_argument('--warm-cache', action='store_true',
+                            help='Keep the next goal cache between calls, rather than emptying it before each.')
+    run_parser.add_argument('--output', default=None, help='JSON file to write the results to.')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser('compare', help='Flag benchmarks slower than in a baseline.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Fraction by which a median may grow before it counts as a regression.')
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
@@ -0,0 +1,54 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Measures how long a fresh interpreter takes to import each module, as every worker process pays it, and fails if
+# the median is over the target or if a module pulls in one of the modules it should not.
+
+modules = ['markov_football.markov', 'markov_football.markov_football', 'markov_football.util',
+           'markov_football.league', 'markov_football.season', 'markov_football.store',
+           'markov_football.instrument']
+
+forbidden_modules = ['pandas']
+
+_probe = '''
+import json, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, modules=sorted(sys.modules))))
+'''
+
+
+def measure(module: str, repeats: int):
+    samples = []
+    loaded = set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _probe % module], check=True, capture_output=True,
+                                text=True).stdout
+        result = json.loads(output)
+        samples.append(result['seconds'])
+        loaded.update(result['modules'])
+    return statistics.median(samples), loaded
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--target', type=float, default=0.25,
+                        help='Largest acceptable median import time of any module, in seconds.')
+    args = parser.parse_args()
+
+    failed = False
+    for module in modules:
+        seconds, loaded = measure(module, args.repeats)
+        imported = [name for name in forbidden_modules if name in loaded]
+        over = seconds > args.target
+        failed = failed or over or bool(imported)
+        print('%-36s %7.3fs%s%s' % (module, seconds, '  OVER TARGET' if over else '',
+                                    '  imports %s' % ', '.join(imported) if imported else ''))
+
+    sys.exit(1 if failed else 0)
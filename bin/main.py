@@ -1,52 +1,145 @@
-from markov_football.markov_football import *
-from markov_football.util import *
-from pprint import pprint
+from markov_football.markov_football import Position, next_goal_cache
+from markov_football.sink import CsvSink, NullSink
+from markov_football.util import ConsoleSink
+from markov_football.league import (players_per_club, create_population, create_selections, play_season,
+                                    play_leagues_in_parallel, load_season_state, season_checkpoint)
+from markov_football.store import has_store, load_player_pool, load_selections, save_player_pool, save_selections
 from markov_football.name import football_clubs_by_league
+from markov_football import instrument
+from collections import OrderedDict, defaultdict, Counter
+import numpy as np
+import argparse
+import json
+import logging
+import os
+
 
 if __name__ == '__main__':
 
-    clubs_by_league = football_clubs_by_league()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Play the leagues in this many worker processes, printing only their final tables.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for the whole run. A run is reproduced exactly by its seed.')
+    parser.add_argument('--world', default=None,
+                        help='Directory of a stored population and lineups to play, created if it does not exist.')
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='Directory to checkpoint every league to after each week.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on each league from its checkpoint, with the seed of the checkpointed run.')
+    parser.add_argument('--results', default=None,
+                        help='Directory to write each league\'s results to as CSV, instead of printing them.')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Report nothing but the final tables.')
+    parser.add_argument('--next-goal-cache', type=int, default=None,
+                        help='Number of pairings to keep in the next goal cache, 0 to turn it off.')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Print counts and times of the hot paths after every week. Needs --workers 1.')
+    args = parser.parse_args()
+    if args.instrument and args.workers > 1:
+        parser.error('--instrument only measures this process, so it cannot be used with --workers.')
 
-    lineups_by_league = OrderedDict(
-        ((league, {club: create_selection(name=club, players=generate_random_player_population(n=17))
-                   for club in clubs})
-         for league, clubs in clubs_by_league.items()))
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    if args.next_goal_cache is not None:
+        next_goal_cache.resize(args.next_goal_cache)
+    if args.instrument:
+        instrument.enable()
 
-    for league, selections_by_name in lineups_by_league.items():
+    seed = args.seed
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        run_path = os.path.join(args.checkpoint_dir, 'run.json')
+        if args.resume and os.path.exists(run_path):
+            with open(run_path) as file:
+                seed = json.load(file)['seed']
 
-        names = list(selections_by_name.keys())
+    seed_sequence = np.random.SeedSequence(seed)
+    print('Seed %d.' % seed_sequence.entropy)
+    population_rng, league_rng = (np.random.default_rng(s) for s in seed_sequence.spawn(2))
 
-        points, wins, draws, losses, goals, conceded_goals = Counter(), Counter(), Counter(), Counter(), Counter(), Counter()
+    if args.checkpoint_dir:
+        with open(run_path + '.tmp', 'w') as file:
+            json.dump(dict(seed=seed_sequence.entropy), file)
+        os.replace(run_path + '.tmp', run_path)
 
-        player_position_history = defaultdict(list)
+    clubs_by_league = football_clubs_by_league()
+    checkpoint_paths = OrderedDict((league, os.path.join(args.checkpoint_dir, league + '.npz'))
+                                   for league in clubs_by_league) if args.checkpoint_dir else {}
+    results_dirs = OrderedDict((league, os.path.join(args.results, league))
+                               for league in clubs_by_league) if args.results else {}
 
-        for week, fixtures_this_week in enumerate(fixtures(selections_by_name.keys())):
-            hold_week(fixtures=fixtures_this_week, selections_by_name=selections_by_name,
-                      player_position_history=player_position_history, goals=goals, conceded_goals=conceded_goals,
-                      points=points, wins=wins, losses=losses, draws=draws)
+    if args.world and has_store(os.path.join(args.world, 'selections')):
+        pool = load_player_pool(os.path.join(args.world, 'players'))
+        all_selections_by_name = load_selections(os.path.join(args.world, 'selections'), pool=pool)
+    else:
+        pool = create_population(clubs_by_league, rng=population_rng)
+        all_selections_by_name = OrderedDict()
+        first_row = 0
+        for clubs in clubs_by_league.values():
+            all_selections_by_name.update(create_selections(clubs=clubs, pool=pool, first_row=first_row))
+            first_row += len(clubs) * players_per_club
 
+        if args.world:
+            save_player_pool(os.path.join(args.world, 'players'), pool)
+            save_selections(os.path.join(args.world, 'selections'), all_selections_by_name.values(), pool=pool)
 
+    if args.workers > 1:
+        tables_by_league = play_leagues_in_parallel(clubs_by_league=clubs_by_league, pool=pool,
+                                                    max_workers=args.workers, rng=league_rng,
+                                                    selections_by_name=all_selections_by_name,
+                                                    checkpoint_paths=checkpoint_paths, resume=args.resume,
+                                                    results_dirs=results_dirs)
+        for league, table in tables_by_league.items():
+            print(league)
+            print(table.to_frame())
+            print()
+    else:
+        for (league, clubs), rng in zip(clubs_by_league.items(), league_rng.spawn(len(clubs_by_league))):
+            selections_by_name = OrderedDict((club, all_selections_by_name[club]) for club in clubs)
+            player_position_history = defaultdict(list)
 
-            data = OrderedDict([('p', [points[name] for name in names]),
-                                ('w', [wins[name] for name in names]),
-                                ('d', [draws[name] for name in names]),
-                                ('l', [losses[name] for name in names]),
-                                ('g', [goals[name] for name in names]),
-                                ('c', [conceded_goals[name] for name in names]),
-                                ('gd', [goals[name] - conceded_goals[name] for name in names])])
-            table = pd.DataFrame(data=data, index=names)
-            table.sort_values(['p', 'gd', 'g'], ascending=[False, False, False], inplace=True)
+            checkpoint_path = checkpoint_paths.get(league)
+            resume_from = None
+            if checkpoint_path and args.resume and os.path.exists(checkpoint_path):
+                resume_from = load_season_state(checkpoint_path, pool=pool)
+                selections_by_name = resume_from.selections_by_name
+                player_position_history = resume_from.player_position_history
+                print('Resuming %s after week %d.' % (league, resume_from.week))
 
-            print('Table after week %d.' % week)
-            print(table)
-            print()
+            if league in results_dirs:
+                sink = CsvSink(results_dirs[league])
+            elif args.quiet:
+                sink = NullSink()
+            else:
+                sink = ConsoleSink()
 
-        for club, selection in selections_by_name.items():
-            print(club)
-            for player in selection.keys():
-                count = Counter(player_position_history[player.name])
-                print(player.name, [(position.name, count[position])
-                                    for position in Position])
-            print()
+            on_week = None
+            if args.instrument:
+                measurements = [instrument.snapshot()]
+
+                def on_week(week, table):
+                    measurements.append(instrument.snapshot())
+                    print('%s, week %d:' % (league, week))
+                    print(instrument.format_snapshot(instrument.difference(measurements[-1], measurements[-2])))
+                    print()
+
+            with sink:
+                table = play_season(selections_by_name=selections_by_name,
+                                    player_position_history=player_position_history, rng=rng,
+                                    resume_from=resume_from,
+                                    checkpoint=season_checkpoint(checkpoint_path, pool) if checkpoint_path else None,
+                                    on_week=on_week, sink=sink)
+
+            if args.quiet or league in results_dirs:
+                print(league)
+                print(table.to_frame())
+                print()
+                continue
 
-        break
+            for club, selection in selections_by_name.items():
+                print(club)
+                for player in selection.keys():
+                    count = Counter(player_position_history[player.name])
+                    print(player.name, [(position.name, count[position])
+                                        for position in Position])
+                print()
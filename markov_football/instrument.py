@@ -0,0 +1,90 @@
+from typing import Callable, Dict, NamedTuple
+from collections import Counter, defaultdict
+import functools
+import inspect
+import time
+
+# Counts and times of the hot paths, kept only while enabled. When disabled, a timed function costs one extra call
+# and a flag check, and count costs a flag check.
+
+enabled = False
+
+_counts = Counter()
+_seconds = defaultdict(float)
+
+
+class Measurement(NamedTuple):
+    count: int
+    seconds: float
+
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    _counts.clear()
+    _seconds.clear()
+
+
+def count(name: str, n: int = 1):
+    if enabled:
+        _counts[name] += n
+
+
+def snapshot() -> Dict[str, Measurement]:
+    return {name: Measurement(count=_counts[name], seconds=_seconds[name])
+            for name in sorted(set(_counts) | set(_seconds))}
+
+
+def difference(after: Dict[str, Measurement], before: Dict[str, Measurement]) -> Dict[str, Measurement]:
+    # What happened between two snapshots.
+    empty = Measurement(count=0, seconds=0.0)
+    return {name: Measurement(count=measurement.count - before.get(name, empty).count,
+                              seconds=measurement.seconds - before.get(name, empty).seconds)
+            for name, measurement in after.items()
+            if measurement != before.get(name, empty)}
+
+
+def format_snapshot(measurements: Dict[str, Measurement]) -> str:
+    lines = []
+    for name, measurement in measurements.items():
+        if measurement.seconds:
+            lines.append('%-36s %10d calls %10.3fs %12.1fus/call' % (
+                name, measurement.count, measurement.seconds, 1e6 * measurement.seconds / max(measurement.count, 1)))
+        else:
+            lines.append('%-36s %10d' % (name, measurement.count))
+    return '\n'.join(lines)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    # Counts the calls of the decorated function and times them, including the whole iteration of a generator.
+    def decorate(function: Callable) -> Callable:
+        if inspect.isgeneratorfunction(function):
+            def timed_generator(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from function(*args, **kwargs)
+                finally:
+                    _counts[name] += 1
+                    _seconds[name] += time.perf_counter() - start
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return function(*args, **kwargs)
+                return timed_generator(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    _counts[name] += 1
+                    _seconds[name] += time.perf_counter() - start
+        return wrapper
+    return decorate
@@ -0,0 +1,283 @@
+from .util import *
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+
+players_per_club = 17
+
+
+class LeagueTable(NamedTuple):
+    names: List[str]
+    points: np.ndarray
+    wins: np.ndarray
+    draws: np.ndarray
+    losses: np.ndarray
+    goals: np.ndarray
+    conceded_goals: np.ndarray
+
+    @staticmethod
+    def from_counters(names: List[str], points: Counter, wins: Counter, draws: Counter, losses: Counter,
+                      goals: Counter, conceded_goals: Counter) -> 'LeagueTable':
+        return LeagueTable(names=list(names),
+                           points=np.array([points[name] for name in names]),
+                           wins=np.array([wins[name] for name in names]),
+                           draws=np.array([draws[name] for name in names]),
+                           losses=np.array([losses[name] for name in names]),
+                           goals=np.array([goals[name] for name in names]),
+                           conceded_goals=np.array([conceded_goals[name] for name in names]))
+
+    def to_frame(self) -> 'pd.DataFrame':
+        import pandas as pd
+        data = OrderedDict([('p', self.points),
+                            ('w', self.wins),
+                            ('d', self.draws),
+                            ('l', self.losses),
+                            ('g', self.goals),
+                            ('c', self.conceded_goals),
+                            ('gd', self.goals - self.conceded_goals)])
+        table = pd.DataFrame(data=data, index=self.names)
+        table.sort_values(['p', 'gd', 'g'], ascending=[False, False, False], inplace=True)
+        return table
+
+
+class SeasonState(NamedTuple):
+    # Everything needed to carry on a season after its first week weeks. seed_sequence is that of the season's rng
+    # before any week's stream was spawned from it.
+    week: int
+    selections_by_name: Dict[str, Selection]
+    player_position_history: Dict[Tuple[str, str], List[Position]]
+    table: LeagueTable
+    seed_sequence: np.random.SeedSequence
+
+
+def _copy_seed_sequence(seed_sequence: np.random.SeedSequence) -> np.random.SeedSequence:
+    return np.random.SeedSequence(entropy=seed_sequence.entropy, spawn_key=seed_sequence.spawn_key,
+                                  pool_size=seed_sequence.pool_size,
+                                  n_children_spawned=seed_sequence.n_children_spawned)
+
+
+def play_season(selections_by_name: Dict[str, Selection],
+                player_position_history: Dict[str, List[Position]] = None,
+                optimiser: Callable[..., Iterable[Selection]] = optmise_player_positions_in_parrallel,
+                expected: bool = False,
+                executor: Executor = None,
+                on_week: Callable[[int, LeagueTable], None] = None,
+                rng: np.random.Generator = None,
+                resume_from: SeasonState = None,
+                checkpoint: Callable[[SeasonState], None] = None,
+                checkpoint_every: int = 1,
+                sink: ResultSink = None) -> LeagueTable:
+    # Holds every week of fixtures, updating selections_by_name and player_position_history in place. Week w is
+    # played with the w-th child stream spawned from rng.
+    # When resuming, the selections, history, table and streams all come from resume_from, rng is not used and the
+    # weeks it has already played are skipped. checkpoint is called with the state after every checkpoint_every
+    # weeks and after the last. Fixture results, lineup changes and the table after each week are sent to sink.
+    names = list(selections_by_name.keys())
+    weeks = list(fixtures(names))
+    if resume_from is None:
+        season_rng = np.random.default_rng(rng)
+        seed_sequence = _copy_seed_sequence(season_rng.bit_generator.seed_seq)
+        week_rngs = season_rng.spawn(len(weeks))
+        first_week = 0
+        table = LeagueTable.from_counters(names, Counter(), Counter(), Counter(), Counter(), Counter(), Counter())
+    else:
+        if list(resume_from.selections_by_name.keys()) != names:
+            raise ValueError('The state is of a different league. names=%r' % list(resume_from.selections_by_name))
+        seed_sequence = resume_from.seed_sequence
+        week_rngs = [np.random.default_rng(s) for s in _copy_seed_sequence(seed_sequence).spawn(len(weeks))]
+        first_week = resume_from.week
+        table = resume_from.table
+        selections_by_name = resume_from.selections_by_name
+        player_position_history = resume_from.player_position_history
+    if player_position_history is None:
+        player_position_history = defaultdict(list)
+
+    points, wins, draws, losses, goals, conceded_goals = (Counter(dict(zip(table.names, column.tolist())))
+                                                          for column in (table.points, table.wins, table.draws,
+                                                                         table.losses, table.goals,
+                                                                         table.conceded_goals))
+
+    for week in range(first_week, len(weeks)):
+        hold_week(fixtures=weeks[week], selections_by_name=selections_by_name,
+                  player_position_history=player_position_history, goals=goals, conceded_goals=conceded_goals,
+                  points=points, wins=wins, losses=losses, draws=draws,
+                  optimiser=optimiser, expected=expected, executor=executor, rng=week_rngs[week], sink=sink,
+                  week=week)
+
+        table = LeagueTable.from_counters(names, points, wins, draws, losses, goals, conceded_goals)
+        if not is_silent(sink):
+            sink.emit(WeekTable(week=week, table=table))
+        if on_week:
+            on_week(week, table)
+        if checkpoint and ((week + 1) % checkpoint_every == 0 or week + 1 == len(weeks)):
+            checkpoint(SeasonState(week=week + 1, selections_by_name=selections_by_name,
+                                   player_position_history=player_position_history, table=table,
+                                   seed_sequence=seed_sequence))
+
+    return table
+
+
+_table_columns = ('points', 'wins', 'draws', 'losses', 'goals', 'conceded_goals')
+
+
+def save_season_state(path: str, state: SeasonState, pool: PlayerPool):
+    # A single uncompressed .npz, written beside path and then renamed over it, so that path always holds a whole
+    # state. Players are referred to by their row in pool, which must be the same pool when the state is loaded.
+    assignments = selection_assignments(selections=state.selections_by_name.values(), pool=pool)
+    histories = list(state.player_position_history.items())
+    seed_sequence = state.seed_sequence
+    if not isinstance(seed_sequence.entropy, int):
+        raise ValueError('Only a seed sequence with integer entropy can be saved. entropy=%r' % seed_sequence.entropy)
+    arrays = dict(week=np.array(state.week),
+                  pool_size=np.array(len(pool)),
+                  club_names=np.array(assignments.club_names, dtype=np.str_),
+                  clubs=assignments.clubs,
+                  players=assignments.players,
+                  positions=assignments.positions,
+                  history_first_names=np.array([name[0] for name, history in histories], dtype=np.str_),
+                  history_last_names=np.array([name[1] for name, history in histories], dtype=np.str_),
+                  history_lengths=np.array([len(history) for name, history in histories], dtype=np.int32),
+                  history_positions=np.array([position_indices[position]
+                                              for name, history in histories
+                                              for position in history], dtype=np.int8),
+                  table_names=np.array(state.table.names, dtype=np.str_),
+                  # The entropy is usually wider than any integer dtype.
+                  seed_entropy=np.array(str(seed_sequence.entropy)),
+                  seed_spawn_key=np.array(seed_sequence.spawn_key, dtype=np.int64),
+                  seed_pool_size=np.array(seed_sequence.pool_size),
+                  seed_n_children_spawned=np.array(seed_sequence.n_children_spawned),
+                  # Each column keeps its own dtype, as an expected season's points and goals are fractional.
+                  **{'table_' + column: np.asarray(getattr(state.table, column)) for column in _table_columns})
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+def load_season_state(path: str, pool: PlayerPool) -> SeasonState:
+    with np.load(path, allow_pickle=False) as arrays:
+        if int(arrays['pool_size']) != len(pool):
+            raise ValueError('The state was saved with a pool of %d players, not %d.' % (int(arrays['pool_size']),
+                                                                                        len(pool)))
+        selections_by_name = selections_from_assignments(
+            assignments=Assignments(club_names=arrays['club_names'].tolist(), clubs=arrays['clubs'],
+                                    players=arrays['players'], positions=arrays['positions']),
+            pool=pool)
+
+        positions = list(Position)
+        player_position_history = defaultdict(list)
+        history_positions = iter(arrays['history_positions'].tolist())
+        for first_name, last_name, length in zip(arrays['history_first_names'].tolist(),
+                                                 arrays['history_last_names'].tolist(),
+                                                 arrays['history_lengths'].tolist()):
+            player_position_history[(first_name, last_name)] = [positions[next(history_positions)]
+                                                                 for _ in range(length)]
+
+        table = LeagueTable(names=arrays['table_names'].tolist(),
+                            **{column: arrays['table_' + column] for column in _table_columns})
+        seed_sequence = np.random.SeedSequence(entropy=int(str(arrays['seed_entropy'])),
+                                               spawn_key=tuple(arrays['seed_spawn_key'].tolist()),
+                                               pool_size=int(arrays['seed_pool_size']),
+                                               n_children_spawned=int(arrays['seed_n_children_spawned']))
+        return SeasonState(week=int(arrays['week']), selections_by_name=selections_by_name,
+                           player_position_history=player_position_history, table=table,
+                           seed_sequence=seed_sequence)
+
+
+def season_checkpoint(path: str, pool: PlayerPool) -> Callable[[SeasonState], None]:
+    return lambda state: save_season_state(path, state, pool)
+
+
+def create_population(clubs_by_league: Dict[str, List[str]], rng: np.random.Generator = None) -> PlayerPool:
+    # players_per_club random players for every club, in league and club order.
+    n_clubs = sum(len(clubs) for clubs in clubs_by_league.values())
+    return generate_random_player_pool(n=n_clubs * players_per_club, rng=rng, club_size=players_per_club)
+
+
+def create_selections(clubs: List[str], pool: PlayerPool, first_row: int = 0) -> Dict[str, Selection]:
+    # Selections for clubs from consecutive blocks of players_per_club players of the pool, starting at first_row.
+    players = (pool[index] for index in range(first_row, first_row + len(clubs) * players_per_club))
+    return OrderedDict((club, create_selection(name=club, players=players)) for club in clubs)
+
+
+_pool_columns = ('ages', 'first_name_indices', 'last_name_indices', 'abilities')
+
+_population = None
+
+
+def _attach_population(columns: Dict[str, Tuple[str, Tuple[int, ...], str]], first_names: Sequence[str],
+                       last_names: Sequence[str]):
+    # Runs once per worker process, which then reads the population without it being pickled with each league.
+    global _population
+    memories = {column: shared_memory.SharedMemory(name=memory_name)
+                for column, (memory_name, shape, dtype) in columns.items()}
+    arrays = {column: np.ndarray(shape=shape, dtype=dtype, buffer=memories[column].buf)
+              for column, (memory_name, shape, dtype) in columns.items()}
+    _population = memories, PlayerPool(first_names=first_names, last_names=last_names, **arrays)
+
+
+def _play_league(assignments: Assignments,
+                 optimiser: Callable[..., Iterable[Selection]], expected: bool,
+                 rng: np.random.Generator, checkpoint_path: str, resume: bool, results_dir: str) -> LeagueTable:
+    memories, pool = _population
+    selections_by_name = selections_from_assignments(assignments=assignments, pool=pool)
+    resume_from = None
+    if checkpoint_path and resume and os.path.exists(checkpoint_path):
+        resume_from = load_season_state(checkpoint_path, pool=pool)
+        selections_by_name = resume_from.selections_by_name
+    with (CsvSink(results_dir) if results_dir else NullSink()) as sink:
+        return play_season(selections_by_name=selections_by_name, optimiser=optimiser, expected=expected, rng=rng,
+                           resume_from=resume_from,
+                           checkpoint=season_checkpoint(checkpoint_path, pool) if checkpoint_path else None,
+                           sink=sink)
+
+
+def play_leagues_in_parallel(clubs_by_league: Dict[str, List[str]], pool: PlayerPool,
+                             optimiser: Callable[..., Iterable[Selection]] = optmise_player_positions_in_parrallel,
+                             expected: bool = False,
+                             max_workers: int = None,
+                             rng: np.random.Generator = None,
+                             selections_by_name: Dict[str, Selection] = None,
+                             checkpoint_paths: Dict[str, str] = None,
+                             resume: bool = False,
+                             results_dirs: Dict[str, str] = None) -> Dict[str, LeagueTable]:
+    # The pool is laid out as create_population lays it out and, unless given, selections are created from it with
+    # create_selections. The pool's columns are copied once into shared memory that every worker attaches to, each
+    # worker is sent only the assignments of its league's players and returns only the final table of its league.
+    # League k is played with the k-th child stream spawned from rng. Leagues in checkpoint_paths are checkpointed
+    # there after every week and, when resuming, carried on from the checkpoint if there is one. Leagues in
+    # results_dirs write their results there as CSV.
+    checkpoint_paths = checkpoint_paths or {}
+    results_dirs = results_dirs or {}
+    memories = {}
+    try:
+        columns = {}
+        for column in _pool_columns:
+            array = np.ascontiguousarray(getattr(pool, column))
+            memories[column] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(shape=array.shape, dtype=array.dtype, buffer=memories[column].buf)[:] = array
+            columns[column] = (memories[column].name, array.shape, array.dtype.str)
+
+        league_rngs = np.random.default_rng(rng).spawn(len(clubs_by_league))
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_attach_population,
+                                 initargs=(columns, pool.first_names, pool.last_names)) as executor:
+            futures = OrderedDict()
+            first_row = 0
+            for (league, clubs), league_rng in zip(clubs_by_league.items(), league_rngs):
+                if selections_by_name is None:
+                    selections = create_selections(clubs=clubs, pool=pool, first_row=first_row).values()
+                else:
+                    selections = [selections_by_name[club] for club in clubs]
+                futures[league] = executor.submit(_play_league, selection_assignments(selections=selections, pool=pool),
+                                                  optimiser, expected, league_rng, checkpoint_paths.get(league), resume,
+                                                  results_dirs.get(league))
+                first_row += len(clubs) * players_per_club
+            return OrderedDict((league, future.result()) for league, future in futures.items())
+    finally:
+        for memory in memories.values():
+            memory.close()
+            memory.unlink()
@@ -1,5 +1,6 @@
-from typing import List, Iterable
+from typing import List, Iterable, Sequence, Tuple, Hashable, Callable, Dict
 from collections import namedtuple, OrderedDict, defaultdict
+from . import instrument
 import numpy as np
 import math
 
@@ -10,47 +11,124 @@ class DuplicateTransitionError(Exception):
     pass
 
 
-class MarkovChain(object):
-    def __init__(self, transitions: List[Tx]):
+# Chains given by transitions with more states than this are kept sparse, as a SparseMarkovChain.
+sparse_state_threshold = 500
+
+
+def _parse_transitions(transitions: List[Tx]) -> Tuple[Dict, Tuple, Tuple]:
+    # Let's preserve the order of states as they appear in the list of transitions.
+
+    tx_dict = defaultdict(dict)
+    for t in transitions:
+        inner = tx_dict[t.s_from]
+        if t.s_to in inner:
+            raise DuplicateTransitionError("A transition from '%r' to '%r' already exists." % (t.s_from, t.s_to))
+        if t.weight <= 0:
+            raise ValueError("Non-positive weight. weight='%f'" % t.weight)
+        inner[t.s_to] = t.weight
 
-        # Let's preserve the order of states as they appear in the list of transitions.
+    states = OrderedDict.fromkeys((s for t in transitions for s in (t.s_from, t.s_to))).keys()
 
-        tx_dict = defaultdict(dict)
-        for t in transitions:
-            inner = tx_dict[t.s_from]
-            if t.s_to in inner:
-                raise DuplicateTransitionError("A transition from '%r' to '%r' already exists." % (t.s_from, t.s_to))
-            if t.weight <= 0:
-                raise ValueError("Non-positive weight. weight='%f'" % t.weight)
-            inner[t.s_to] = t.weight
+    absorbing_states = OrderedDict.fromkeys(
+        (s for s in states if s not in tx_dict or sum(tx_dict[s].values()) <= 0)).keys()
 
-        states = OrderedDict.fromkeys((s for t in transitions for s in (t.s_from, t.s_to))).keys()
+    transient_states = OrderedDict.fromkeys(
+        (s for s in states if s not in absorbing_states)).keys()
 
-        absorbing_states = OrderedDict.fromkeys(
-            (s for s in states if s not in tx_dict or sum(tx_dict[s].values()) <= 0)).keys()
+    return tx_dict, tuple(transient_states), tuple(absorbing_states)
+
+
+class MarkovChain(object):
+    def __new__(cls, transitions: List[Tx] = None, sparse: bool = None):
+        # MarkovChain(transitions) is a SparseMarkovChain when sparse, which by default it is for chains of more than
+        # sparse_state_threshold states.
+        if cls is MarkovChain and transitions is not None:
+            if sparse is None:
+                sparse = len({s for t in transitions for s in (t.s_from, t.s_to)}) > sparse_state_threshold
+            if sparse:
+                cls = SparseMarkovChain
+        return super().__new__(cls)
 
-        transient_states = OrderedDict.fromkeys(
-            (s for s in states if s not in absorbing_states)).keys()
+    @instrument.timed('markov_chain.build')
+    def __init__(self, transitions: List[Tx], sparse: bool = None):
+        tx_dict, transient_states, absorbing_states = _parse_transitions(transitions)
+        ordered_states = transient_states + absorbing_states
 
-        self.transient_states = tuple(transient_states)
-        self.absorbing_states = tuple(absorbing_states)
+        transition_matrix = np.array(
+            [[tx_dict.get(s_from, {s_from: 1.0}).get(s_to, 0.0) for s_to in ordered_states]
+             for s_from in ordered_states], dtype=np.float64)
+
+        self._initialise(transient_states=transient_states,
+                         absorbing_states=absorbing_states,
+                         transition_matrix=transition_matrix / transition_matrix.sum(axis=1, keepdims=True))
+
+    @classmethod
+    def from_transition_matrix(cls, transient_states: Sequence, absorbing_states: Sequence,
+                               transition_matrix: np.ndarray) -> 'MarkovChain':
+        # Trusts that the matrix is row-stochastic and ordered transient states first, then absorbing states.
+        mc = cls.__new__(cls)
+        mc._initialise(transient_states=tuple(transient_states),
+                       absorbing_states=tuple(absorbing_states),
+                       transition_matrix=np.asarray(transition_matrix, dtype=np.float64))
+        return mc
+
+    def _initialise(self, transient_states: Tuple, absorbing_states: Tuple, transition_matrix: np.ndarray):
+        self.transient_states = transient_states
+        self.absorbing_states = absorbing_states
 
         self.states = self.transient_states + self.absorbing_states
         self.state_indices = {s: i for i, s in enumerate(self.states)}
 
-        transition_matrix = np.matrix(
-            [[tx_dict.get(s_from, {s_from: 1.0}).get(s_to, 0.0) for s_to in self.states]
-             for s_from in self.states], dtype=np.float64)
-
-        self.transition_matrix = transition_matrix / np.tile(transition_matrix.sum(axis=1),
-                                                             (1, transition_matrix.shape[1]))
+        self.transition_matrix = transition_matrix
 
         n_transient_states = len(self.transient_states)
         self.Q = self.transition_matrix[:n_transient_states, :n_transient_states]
         self.R = self.transition_matrix[:n_transient_states, n_transient_states:]
 
-        self.N = np.linalg.inv(np.identity(len(self.transient_states), dtype=np.float64) - self.Q)
-        self.B = self.N * self.R
+        # The fundamental matrix N = inv(I - Q) and B = N R are only computed when first used, as simulation needs
+        # neither and outcomes of a few start states are solved for directly.
+        self._N = None
+        self._B = None
+        self._B_rows = {}
+
+    @property
+    def N(self) -> np.ndarray:
+        if self._N is None:
+            self._N = np.linalg.inv(np.identity(len(self.transient_states), dtype=np.float64) - self.Q)
+        return self._N
+
+    @property
+    def B(self) -> np.ndarray:
+        if self._B is None:
+            instrument.count('markov_chain.full_solve')
+            self._B = np.linalg.solve(np.identity(len(self.transient_states), dtype=np.float64) - self.Q, self.R)
+        return self._B
+
+    @instrument.timed('markov_chain.solve')
+    def absorption_probabilities_given_states(self, states: Sequence) -> np.ndarray:
+        # The rows of B for transient states, by solving (I - Q)^T x = e_s for just those states that have not been
+        # solved for before, unless B is already known. An absorbing state is absorbed in itself.
+        indices = []
+        for s in states:
+            if s not in self.state_indices:
+                raise ValueError('No such state. s=%r' % s)
+            indices.append(self.state_indices[s])
+
+        n_transient_states = len(self.transient_states)
+        if self._B is None:
+            unsolved = list(OrderedDict.fromkeys(index for index in indices
+                                                 if index < n_transient_states and index not in self._B_rows))
+            if unsolved:
+                unit_vectors = np.zeros(shape=(n_transient_states, len(unsolved)), dtype=np.float64)
+                unit_vectors[unsolved, np.arange(len(unsolved))] = 1.0
+                N_rows = np.linalg.solve((np.identity(n_transient_states, dtype=np.float64) - self.Q).T,
+                                         unit_vectors).T
+                self._B_rows.update(zip(unsolved, N_rows @ self.R))
+        rows = self._B_rows if self._B is None else self._B
+
+        absorbed = np.identity(len(self.absorbing_states), dtype=np.float64)
+        return np.array([rows[index] if index < n_transient_states else absorbed[index - n_transient_states]
+                         for index in indices], dtype=np.float64).reshape(len(indices), len(self.absorbing_states))
 
     def calculate_outcome_given_state(self, s):
         if s not in self.states:
@@ -59,20 +137,476 @@ class MarkovChain(object):
         if s in self.absorbing_states:
             return {s: 1.0}
 
-        return {state: self.B[self.state_indices[s], i] for i, state in enumerate(self.absorbing_states)}
+        probs, = self.absorption_probabilities_given_states([s])
+        return dict(zip(self.absorbing_states, probs))
 
     def calculate_mean_outcome_given_states(self, states: Iterable):
+        # Absorbing states only contribute to their own mean, as calculate_outcome_given_state gives them no others.
+        states = list(states)
+        probs = self.absorption_probabilities_given_states(states)
         outcomes_given_states = defaultdict(list)
-        for s in states:
-            for absorbing_state, prob in self.calculate_outcome_given_state(s).items():
+        for s, row in zip(states, probs):
+            if s in self.absorbing_states:
+                outcomes_given_states[s].append(1.0)
+                continue
+            for absorbing_state, prob in zip(self.absorbing_states, row):
                 outcomes_given_states[absorbing_state].append(prob)
         return {absorbing_state: np.mean(probs)
                 for absorbing_state, probs in outcomes_given_states.items()}
 
-    def simulate_next(self, s):
+    def absorption_count_distribution(self, s, steps: int, restarts: Dict) -> np.ndarray:
+        # Runs the chain from s for a number of steps where, on being absorbed, it restarts from restarts[absorbing
+        # state] on the next step. Returns the exact joint distribution of how often it was absorbed in each absorbing
+        # state, an array with one axis of length steps + 1 per absorbing state.
+        if s not in self.transient_states:
+            raise ValueError('No such transient state. s=%r' % s)
+        if set(restarts) != set(self.absorbing_states):
+            raise ValueError('Need a restart state for every absorbing state.')
+
+        n_transient_states, n_absorbing_states = len(self.transient_states), len(self.absorbing_states)
+        restart_indices = [self.state_indices[restarts[a]] for a in self.absorbing_states]
+        if any(index >= n_transient_states for index in restart_indices):
+            raise ValueError('Restart states must be transient.')
+
+        counts_shape = (steps + 1,) * n_absorbing_states
+        distribution = np.zeros(shape=(n_transient_states,) + counts_shape, dtype=np.float64)
+        distribution[(self.state_indices[s],) + (0,) * n_absorbing_states] = 1.0
+
+        for step in range(steps):
+            transient, absorbed = self._step_distribution(distribution.reshape(n_transient_states, -1))
+            absorbed = absorbed.reshape((n_absorbing_states,) + counts_shape)
+            distribution = transient.reshape(distribution.shape)
+            for a, restart_index in enumerate(restart_indices):
+                # Counts cannot exceed the number of steps taken so far, so nothing falls off the end.
+                source = tuple(slice(None, -1) if axis == a else slice(None) for axis in range(n_absorbing_states))
+                target = tuple(slice(1, None) if axis == a else slice(None) for axis in range(n_absorbing_states))
+                distribution[restart_index][target] += absorbed[a][source]
+
+        return distribution.sum(axis=0)
+
+    def _step_distribution(self, flat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # One step of a (transient states x K) distribution: Q^T flat and R^T flat.
+        return self.Q.T @ flat, self.R.T @ flat
+
+    def _cumulative_transitions(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Per-state cumulative transition probabilities and the last state each row can reach, computed once.
+        if getattr(self, '_cumulative', None) is None:
+            self._cumulative = np.cumsum(self.transition_matrix, axis=1)
+            self._last_reachable = len(self.states) - 1 - np.argmax(self.transition_matrix[:, ::-1] > 0, axis=1)
+        return self._cumulative, self._last_reachable
+
+    def _sample_next_indices(self, indices: np.ndarray, u: np.ndarray) -> np.ndarray:
+        # The state after each of indices, chosen by inverting its row's cumulative probabilities at u.
+        cumulative, last_reachable = self._cumulative_transitions()
+        return np.minimum((u[:, np.newaxis] >= cumulative[indices]).sum(axis=1), last_reachable[indices])
+
+    def sample_absorption_counts(self, s, steps: int, restarts: Dict, n_runs: int,
+                                 rng: np.random.Generator = None) -> np.ndarray:
+        # Samples n_runs independent runs of what absorption_count_distribution describes, advancing all of them in
+        # lockstep. Returns an (n_runs x absorbing states) array of absorption counts.
+        if s not in self.transient_states:
+            raise ValueError('No such transient state. s=%r' % s)
+        if set(restarts) != set(self.absorbing_states):
+            raise ValueError('Need a restart state for every absorbing state.')
+
+        rng = np.random.default_rng(rng)
+        n_transient_states = len(self.transient_states)
+
+        next_indices = np.arange(len(self.states))
+        for a in self.absorbing_states:
+            next_indices[self.state_indices[a]] = self.state_indices[restarts[a]]
+
+        indices = np.full(n_runs, self.state_indices[s], dtype=np.intp)
+        counts = np.zeros(shape=(n_runs, len(self.absorbing_states)), dtype=np.int64)
+        runs = np.arange(n_runs)
+        for step in range(steps):
+            u = rng.random(n_runs)
+            sampled = self._sample_next_indices(indices, u)
+            absorbed = sampled >= n_transient_states
+            counts[runs[absorbed], sampled[absorbed] - n_transient_states] += 1
+            indices = next_indices[sampled]
+
+        return counts
+
+    def simulate_next(self, s, rng: np.random.Generator = None):
         if s not in self.states:
             raise ValueError('No such state. s=%r' % s)
-        n = len(self.states)
-        tx_probs = [self.transition_matrix[self.state_indices[s], col] for col in range(n)]
-        s_index = np.random.choice(n, p=tx_probs)
+        s_index = np.random.default_rng(rng).choice(len(self.states), p=self.transition_matrix[self.state_indices[s]])
         return self.states[s_index]
+
+
+def _bicgstab(matvec: Callable[[np.ndarray], np.ndarray], b: np.ndarray, tolerance: float,
+              max_iterations: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Solves A x = b for each column of b by BiCGSTAB, given x -> A x. A column has converged once its residual
+    # |b - A x| is at most tolerance |b|. Returns the solutions and which columns converged; a column that did not
+    # converge, or whose iteration broke down, keeps its last iterate.
+    x = np.zeros_like(b)
+    converged = np.zeros(b.shape[1], dtype=bool)
+    b_norms = np.linalg.norm(b, axis=0)
+    converged[b_norms == 0.0] = True
+    active = np.flatnonzero(~converged)
+
+    r = b[:, active].copy()
+    r_hat = r.copy()
+    p = np.zeros_like(r)
+    v = np.zeros_like(r)
+    rho = alpha = omega = np.ones(len(active))
+    for _ in range(max_iterations):
+        if not len(active):
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho_next = (r_hat * r).sum(axis=0)
+            beta = (rho_next / rho) * (alpha / omega)
+            p = r + beta * (p - omega * v)
+            v = matvec(p)
+            alpha = rho_next / (r_hat * v).sum(axis=0)
+            s = r - alpha * v
+            t = matvec(s)
+            omega = (t * s).sum(axis=0) / (t * t).sum(axis=0)
+            # Where s is already zero, alpha p alone solves the column and omega is 0 / 0.
+            omega = np.where(np.isfinite(omega), omega, 0.0)
+        x[:, active] += alpha * p + omega * s
+        r = s - omega * t
+        rho = rho_next
+
+        residuals = np.linalg.norm(r, axis=0)
+        done = residuals <= tolerance * b_norms[active]
+        broken = ~np.isfinite(residuals) | ~np.isfinite(alpha) | (rho == 0.0) | (omega == 0.0)
+        converged[active[done]] = True
+        keep = ~(done | broken)
+        if not keep.all():
+            active, r, r_hat, p, v = active[keep], r[:, keep], r_hat[:, keep], p[:, keep], v[:, keep]
+            rho, alpha, omega = rho[keep], alpha[keep], omega[keep]
+    return x, converged
+
+
+def _segment_sums(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    # Sums of values[indptr[r]:indptr[r + 1]] for each r, along the first axis.
+    n = len(indptr) - 1
+    sums = np.zeros(shape=(n,) + values.shape[1:], dtype=np.float64)
+    non_empty = indptr[1:] > indptr[:-1]
+    if non_empty.any():
+        sums[non_empty] = np.add.reduceat(values, indptr[:-1][non_empty], axis=0)
+    return sums
+
+
+class _Csr(object):
+    # A compressed sparse row matrix, just enough of one for products with dense vectors and matrices.
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, data: np.ndarray, shape: Tuple[int, int]):
+        order = np.lexsort((cols, rows))
+        self.shape = shape
+        self.indices = cols[order]
+        self.data = data[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=shape[0]))]).astype(np.intp)
+
+    def rows(self) -> np.ndarray:
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def transpose(self) -> '_Csr':
+        return _Csr(rows=self.indices, cols=self.rows(), data=self.data, shape=(self.shape[1], self.shape[0]))
+
+    def __matmul__(self, x: np.ndarray) -> np.ndarray:
+        products = self.data.reshape((-1,) + (1,) * (x.ndim - 1)) * x[self.indices]
+        return _segment_sums(products, self.indptr)
+
+    def toarray(self) -> np.ndarray:
+        dense = np.zeros(shape=self.shape, dtype=np.float64)
+        dense[self.rows(), self.indices] = self.data
+        return dense
+
+    def to_scipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+
+class SparseMarkovChain(MarkovChain):
+    # A MarkovChain kept as a CSR transition matrix, so that its memory and the cost of solving and simulating it
+    # grow with its transitions rather than with the square of its states. Absorption is solved by a sparse LU
+    # factorisation of I - Q when scipy is installed and otherwise by BiCGSTAB on I - Q, falling back to a dense solve
+    # for any column it does not bring within tolerance (relative to the right-hand side) in max_iterations.
+    # transition_matrix, Q, R and N are dense arrays, made on demand.
+    tolerance = 1e-12
+    max_iterations = 10000
+
+    @instrument.timed('markov_chain.build_sparse')
+    def __init__(self, transitions: List[Tx], sparse: bool = None):
+        tx_dict, transient_states, absorbing_states = _parse_transitions(transitions)
+        state_indices = {s: i for i, s in enumerate(transient_states + absorbing_states)}
+
+        n, n_transient_states = len(state_indices), len(transient_states)
+        rows = np.array([state_indices[s_from] for s_from, targets in tx_dict.items() for s_to in targets] +
+                        list(range(n_transient_states, n)), dtype=np.intp)
+        cols = np.array([state_indices[s_to] for s_from, targets in tx_dict.items() for s_to in targets] +
+                        list(range(n_transient_states, n)), dtype=np.intp)
+        weights = np.array([weight for targets in tx_dict.values() for weight in targets.values()] +
+                           [1.0] * (n - n_transient_states), dtype=np.float64)
+        weights /= np.bincount(rows, weights=weights, minlength=n)[rows]
+        self._initialise_sparse(transient_states=transient_states, absorbing_states=absorbing_states,
+                                rows=rows, cols=cols, weights=weights)
+
+    @classmethod
+    def from_transition_matrix(cls, transient_states: Sequence, absorbing_states: Sequence,
+                               transition_matrix: np.ndarray) -> 'SparseMarkovChain':
+        # As MarkovChain.from_transition_matrix, keeping only the matrix's non-zero entries.
+        transition_matrix = np.asarray(transition_matrix, dtype=np.float64)
+        rows, cols = np.nonzero(transition_matrix)
+        mc = cls.__new__(cls)
+        mc._initialise_sparse(transient_states=tuple(transient_states), absorbing_states=tuple(absorbing_states),
+                              rows=rows.astype(np.intp), cols=cols.astype(np.intp),
+                              weights=transition_matrix[rows, cols])
+        return mc
+
+    def _initialise_sparse(self, transient_states: Tuple, absorbing_states: Tuple, rows: np.ndarray,
+                           cols: np.ndarray, weights: np.ndarray):
+        self.transient_states = transient_states
+        self.absorbing_states = absorbing_states
+        self.states = self.transient_states + self.absorbing_states
+        self.state_indices = {s: i for i, s in enumerate(self.states)}
+
+        n, n_transient_states = len(self.states), len(self.transient_states)
+        self.transition_csr = _Csr(rows=rows, cols=cols, data=weights, shape=(n, n))
+
+        transient = rows < n_transient_states
+        to_transient = transient & (cols < n_transient_states)
+        to_absorbing = transient & (cols >= n_transient_states)
+        self._Q = _Csr(rows=rows[to_transient], cols=cols[to_transient], data=weights[to_transient],
+                       shape=(n_transient_states, n_transient_states))
+        self._R = _Csr(rows=rows[to_absorbing], cols=cols[to_absorbing] - n_transient_states,
+                       data=weights[to_absorbing], shape=(n_transient_states, n - n_transient_states))
+        self._Q_transposed = self._Q.transpose()
+        self._R_transposed = self._R.transpose()
+
+        self._N = None
+        self._B = None
+        self._B_rows = {}
+        self._lu = None
+        self._sampling = None
+
+    @property
+    def transition_matrix(self) -> np.ndarray:
+        return self.transition_csr.toarray()
+
+    @property
+    def Q(self) -> np.ndarray:
+        return self._Q.toarray()
+
+    @property
+    def R(self) -> np.ndarray:
+        return self._R.toarray()
+
+    def _factorised(self):
+        # A sparse LU factorisation of I - Q, or None without scipy.
+        if self._lu is None:
+            try:
+                from scipy.sparse import identity
+                from scipy.sparse.linalg import splu
+            except ImportError:
+                self._lu = False
+            else:
+                n_transient_states = len(self.transient_states)
+                self._lu = splu((identity(n_transient_states, format='csc') - self._Q.to_scipy()).tocsc())
+        return self._lu or None
+
+    def _solve(self, b: np.ndarray, transposed: bool) -> np.ndarray:
+        # x with (I - Q) x = b, or (I - Q)^T x = b when transposed.
+        lu = self._factorised()
+        if lu is not None:
+            return lu.solve(b, trans='T' if transposed else 'N')
+
+        Q = self._Q_transposed if transposed else self._Q
+        columns = b.reshape(len(b), -1).astype(np.float64)
+        x, converged = _bicgstab(lambda y: y - Q @ y, columns, tolerance=self.tolerance,
+                                 max_iterations=self.max_iterations)
+        if not converged.all():
+            instrument.count('markov_chain.dense_fallback')
+            A = np.identity(len(self.transient_states), dtype=np.float64) - Q.toarray()
+            x[:, ~converged] = np.linalg.solve(A, columns[:, ~converged])
+        return x.reshape(b.shape)
+
+    @property
+    def N(self) -> np.ndarray:
+        if self._N is None:
+            self._N = self._solve(np.identity(len(self.transient_states), dtype=np.float64), transposed=False)
+        return self._N
+
+    @property
+    def B(self) -> np.ndarray:
+        if self._B is None:
+            instrument.count('markov_chain.full_solve')
+            self._B = self._solve(self._R.toarray(), transposed=False)
+        return self._B
+
+    @instrument.timed('markov_chain.solve')
+    def absorption_probabilities_given_states(self, states: Sequence) -> np.ndarray:
+        indices = []
+        for s in states:
+            if s not in self.state_indices:
+                raise ValueError('No such state. s=%r' % s)
+            indices.append(self.state_indices[s])
+
+        n_transient_states = len(self.transient_states)
+        if self._B is None:
+            unsolved = list(OrderedDict.fromkeys(index for index in indices
+                                                 if index < n_transient_states and index not in self._B_rows))
+            if unsolved:
+                unit_vectors = np.zeros(shape=(n_transient_states, len(unsolved)), dtype=np.float64)
+                unit_vectors[unsolved, np.arange(len(unsolved))] = 1.0
+                N_rows = self._solve(unit_vectors, transposed=True)
+                self._B_rows.update(zip(unsolved, (self._R_transposed @ N_rows).T))
+        rows = self._B_rows if self._B is None else self._B
+
+        absorbed = np.identity(len(self.absorbing_states), dtype=np.float64)
+        return np.array([rows[index] if index < n_transient_states else absorbed[index - n_transient_states]
+                         for index in indices], dtype=np.float64).reshape(len(indices), len(self.absorbing_states))
+
+    def _step_distribution(self, flat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self._Q_transposed @ flat, self._R_transposed @ flat
+
+    def _sample_next_indices(self, indices: np.ndarray, u: np.ndarray) -> np.ndarray:
+        # As MarkovChain does it: the first transition of each row whose cumulative probability exceeds u, or the
+        # row's last transition. A binary search over each row's own slice of the CSR data, so that sampling needs
+        # no more memory than the transitions do.
+        csr = self.transition_csr
+        if self._sampling is None:
+            # Each row's cumulative sums, accumulated in the same order as np.cumsum does along a dense row.
+            lengths = np.diff(csr.indptr)
+            longest_first = np.argsort(-lengths, kind='stable')
+            starts, descending = csr.indptr[:-1][longest_first], lengths[longest_first]
+            cumulative = csr.data.copy()
+            for k in range(1, lengths.max(initial=1)):
+                positions = starts[:np.searchsorted(-descending, -k, side='left')] + k
+                cumulative[positions] += cumulative[positions - 1]
+            self._sampling = cumulative
+        cumulative = self._sampling
+        low, high = csr.indptr[indices], csr.indptr[indices + 1] - 1
+        while True:
+            searching = low < high
+            if not searching.any():
+                return csr.indices[low]
+            middle = (low + high) // 2
+            above = cumulative[middle] > u
+            high = np.where(searching & above, middle, high)
+            low = np.where(searching & ~above, middle + 1, low)
+
+    def simulate_next(self, s, rng: np.random.Generator = None):
+        if s not in self.states:
+            raise ValueError('No such state. s=%r' % s)
+        u = np.random.default_rng(rng).random(1)
+        return self.states[int(self._sample_next_indices(np.array([self.state_indices[s]]), u)[0])]
+
+
+class MarkovChainTemplate(object):
+    def __init__(self, edges: List[Tuple[Hashable, Hashable]]):
+
+        # The topology of a chain, i.e. its transitions without weights. States are ordered exactly as
+        # MarkovChain would order them so that chains created from weights are interchangeable.
+
+        targets_by_source = defaultdict(set)
+        for s_from, s_to in edges:
+            if s_to in targets_by_source[s_from]:
+                raise DuplicateTransitionError("A transition from '%r' to '%r' already exists." % (s_from, s_to))
+            targets_by_source[s_from].add(s_to)
+
+        states = OrderedDict.fromkeys((s for edge in edges for s in edge)).keys()
+
+        self.transient_states = tuple(s for s in states if s in targets_by_source)
+        self.absorbing_states = tuple(s for s in states if s not in targets_by_source)
+        self.states = self.transient_states + self.absorbing_states
+        self.state_indices = {s: i for i, s in enumerate(self.states)}
+
+        self.n_weights = len(edges)
+        self._rows = np.array([self.state_indices[s_from] for s_from, s_to in edges], dtype=np.intp)
+        self._cols = np.array([self.state_indices[s_to] for s_from, s_to in edges], dtype=np.intp)
+        self._absorbing_indices = np.arange(len(self.transient_states), len(self.states), dtype=np.intp)
+
+    def transition_matrices(self, weights: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        # weights has shape (..., n_weights), one weight per edge in the order given to the constructor.
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape[-1] != self.n_weights:
+            raise ValueError('Expected %d weights. shape=%r' % (self.n_weights, weights.shape))
+
+        n = len(self.states)
+        if out is None:
+            out = np.zeros(shape=weights.shape[:-1] + (n, n), dtype=np.float64)
+        else:
+            out.fill(0.0)
+
+        out[..., self._rows, self._cols] = weights
+        out[..., self._absorbing_indices, self._absorbing_indices] = 1.0
+        out /= out.sum(axis=-1, keepdims=True)
+        return out
+
+    @instrument.timed('markov_chain.create')
+    def create(self, weights: np.ndarray, state_map: Callable[[Hashable], Hashable] = None) -> MarkovChain:
+        transient_states, absorbing_states = self.transient_states, self.absorbing_states
+        if state_map:
+            transient_states = tuple(map(state_map, transient_states))
+            absorbing_states = tuple(map(state_map, absorbing_states))
+        return MarkovChain.from_transition_matrix(transient_states=transient_states,
+                                                  absorbing_states=absorbing_states,
+                                                  transition_matrix=self.transition_matrices(weights))
+
+    def absorption_gradients(self, weights: np.ndarray, start_distribution: np.ndarray,
+                             absorbing_index: int) -> Tuple[np.ndarray, np.ndarray]:
+        # For (..., n_weights) weights, the probability of being absorbed in absorbing_states[absorbing_index] when
+        # starting from start_distribution over the transient states, and its (..., n_weights) gradient. With
+        # u = start N and b the column of B, d(u R) = u dP [b; e] over the transient rows of P, so u and b are all
+        # that need solving, one vector each. Each row of P is its weights over their sum, which gives the gradient
+        # with respect to the weights themselves.
+        weights = np.asarray(weights, dtype=np.float64)
+        n_transient_states = len(self.transient_states)
+        transition_matrices = self.transition_matrices(weights)
+        A = np.identity(n_transient_states, dtype=np.float64) - transition_matrices[..., :n_transient_states,
+                                                                                    :n_transient_states]
+        R = transition_matrices[..., :n_transient_states, n_transient_states:]
+
+        start_distribution = np.broadcast_to(np.asarray(start_distribution, dtype=np.float64),
+                                             A.shape[:-2] + (n_transient_states,))
+        u = np.linalg.solve(np.swapaxes(A, -1, -2), start_distribution[..., np.newaxis])[..., 0]
+        b = np.linalg.solve(A, R[..., absorbing_index, np.newaxis])[..., 0]
+        probability = (u[..., np.newaxis, :] @ R[..., absorbing_index, np.newaxis])[..., 0, 0]
+
+        absorbed = np.zeros(shape=len(self.absorbing_states), dtype=np.float64)
+        absorbed[absorbing_index] = 1.0
+        x = np.concatenate((b, np.broadcast_to(absorbed, b.shape[:-1] + absorbed.shape)), axis=-1)
+
+        edge_gradients = u[..., self._rows] * x[..., self._cols]
+        edge_probabilities = transition_matrices[..., self._rows, self._cols]
+        row_indicators = np.zeros(shape=(self.n_weights, len(self.states)), dtype=np.float64)
+        row_indicators[np.arange(self.n_weights), self._rows] = 1.0
+        row_sums = weights @ row_indicators
+        row_means = (edge_probabilities * edge_gradients) @ row_indicators
+        return probability, (edge_gradients - row_means[..., self._rows]) / row_sums[..., self._rows]
+
+
+@instrument.timed('absorption_probabilities')
+def absorption_probabilities(transition_matrices: np.ndarray, n_transient_states: int) -> np.ndarray:
+    # Solves B = inv(I - Q) * R for a (K, n, n) stack of row-stochastic matrices whose first
+    # n_transient_states states are transient, returning the (K, n_transient_states, n - n_transient_states) stack.
+    transition_matrices = np.asarray(transition_matrices, dtype=np.float64)
+    if transition_matrices.ndim < 2 or transition_matrices.shape[-1] != transition_matrices.shape[-2]:
+        raise ValueError('Expected a stack of square matrices. shape=%r' % (transition_matrices.shape,))
+
+    instrument.count('absorption_probabilities.matrices', int(np.prod(transition_matrices.shape[:-2])))
+    Q = transition_matrices[..., :n_transient_states, :n_transient_states]
+    R = transition_matrices[..., :n_transient_states, n_transient_states:]
+    return np.linalg.solve(np.identity(n_transient_states, dtype=np.float64) - Q, R)
+
+
+def stack_transition_matrices(chains: Sequence[MarkovChain]) -> np.ndarray:
+    chains = list(chains)
+    if not chains:
+        raise ValueError('Need at least one chain.')
+
+    n_transient_states, n_absorbing_states = len(chains[0].transient_states), len(chains[0].absorbing_states)
+    for mc in chains:
+        if len(mc.transient_states) != n_transient_states or len(mc.absorbing_states) != n_absorbing_states:
+            raise ValueError('Chains must share the same number of transient and absorbing states.')
+
+    return np.stack([mc.transition_matrix for mc in chains])
+
+
+def batch_absorption_probabilities(chains: Sequence[MarkovChain]) -> np.ndarray:
+    chains = list(chains)
+    return absorption_probabilities(stack_transition_matrices(chains),
+                                    n_transient_states=len(chains[0].transient_states))
@@ -1,16 +1,14 @@
-from typing import Tuple, Dict, List, Iterable, NamedTuple, Generator
-from .markov import MarkovChain, Tx
+from typing import Tuple, Dict, List, Iterable, NamedTuple, Generator, Sequence
+from .markov import MarkovChain, MarkovChainTemplate, Tx, absorption_probabilities
 from .name import NamesGenerator
 from enum import Enum, auto
 from collections import UserDict, defaultdict, OrderedDict, Counter
 import numpy as np
-import math
-import pandas as pd
 import logging
 
-logger = logging.getLogger()
-logger.setLevel(logging.WARN)
-logger.addHandler(logging.StreamHandler())
+# pandas is only imported by the functions that build frames, so that the engine and worker processes start without
+# it. Handlers and levels are left to the application.
+logger = logging.getLogger(__name__)
 
 goal_keeper_correction = 3.0
 
@@ -25,6 +23,19 @@ class Position(Enum):
 
 outfield_positions = frozenset((Position.D, Position.M, Position.F))
 
+position_indices = {position: i for i, position in enumerate(Position)}
+
+max_outfield_players = 10
+max_goal_keepers = 1
+
+_outfield_mask = np.array([position in outfield_positions for position in Position])
+
+
+def position_counts_are_valid(position_counts: np.ndarray) -> np.ndarray:
+    # (..., positions) counts indexed by position_indices, checked against the rules of Selection.
+    return ((position_counts[..., _outfield_mask].sum(axis=-1) <= max_outfield_players) &
+            (position_counts[..., position_indices[Position.GK]] <= max_goal_keepers))
+
 
 class TeamState(Enum):
     WITH_GK = auto()
@@ -47,17 +58,90 @@ class Ability(Enum):
     PASSING = auto()
 
 
+ability_indices = {ability: i for i, ability in enumerate(Ability)}
+
+_position_corrections = np.array([goal_keeper_correction if position is Position.GK else 1.0
+                                  for position in Position], dtype=np.float64)
+
+
+def position_ability_totals(position_ability_sums: np.ndarray) -> np.ndarray:
+    # Works on (..., positions, abilities) stacks of per-position ability sums.
+    return np.sqrt(position_ability_sums * _position_corrections[:, np.newaxis])
+
+
+def position_ability_sum_gradients(position_ability_sums: np.ndarray, totals_gradients: np.ndarray) -> np.ndarray:
+    # Takes gradients with respect to position_ability_totals back to the sums, through the square root. A sum of 0
+    # has an infinite gradient in any direction the totals gradient is not 0 in.
+    totals = position_ability_totals(position_ability_sums)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gradients = totals_gradients * _position_corrections[:, np.newaxis] / (2.0 * totals)
+    return np.nan_to_num(gradients, nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+
 class Abilities(UserDict):
     def __init__(self, abilities: Dict[Ability, float] = {}):
         abilities.update({ability: 0.0 for ability in Ability if ability not in abilities})
         super().__init__(abilities)
 
 
+class PlayerPool(object):
+    # Players stored column-wise: ages, indices into the first and last name tables and a float32
+    # (players x abilities) matrix with columns in Ability order.
+    def __init__(self, ages: np.ndarray, first_name_indices: np.ndarray, last_name_indices: np.ndarray,
+                 abilities: np.ndarray, first_names: Sequence[str], last_names: Sequence[str]):
+        self.ages = np.asarray(ages, dtype=np.int16)
+        self.first_name_indices = np.asarray(first_name_indices, dtype=np.int32)
+        self.last_name_indices = np.asarray(last_name_indices, dtype=np.int32)
+        self.abilities = np.asarray(abilities, dtype=np.float32).reshape(-1, len(Ability))
+        self.first_names = first_names
+        self.last_names = last_names
+
+        if not (len(self.ages) == len(self.first_name_indices) == len(self.last_name_indices) ==
+                len(self.abilities)):
+            raise ValueError('Need the same number of ages, names and abilities.')
+
+    def __len__(self):
+        return len(self.ages)
+
+    def __getitem__(self, index: int) -> 'Player':
+        if not -len(self) <= index < len(self):
+            raise IndexError('No such player. index=%d' % index)
+        return Player(pool=self, index=index % len(self))
+
+    def __iter__(self) -> Iterable['Player']:
+        return (Player(pool=self, index=index) for index in range(len(self)))
+
+
 class Player(object):
-    def __init__(self, name: Tuple[str, str], age: int, abilities: Abilities):
-        self.name = name
-        self.age = age
-        self.abilities = abilities
+    # A view of one row of a PlayerPool.
+    __slots__ = ('pool', 'index')
+
+    def __init__(self, pool: PlayerPool, index: int):
+        self.pool = pool
+        self.index = index
+
+    @property
+    def name(self) -> Tuple[str, str]:
+        return (str(self.pool.first_names[self.pool.first_name_indices[self.index]]),
+                str(self.pool.last_names[self.pool.last_name_indices[self.index]]))
+
+    @property
+    def age(self) -> int:
+        return int(self.pool.ages[self.index])
+
+    @property
+    def ability_vector(self) -> np.ndarray:
+        return self.pool.abilities[self.index]
+
+    @property
+    def abilities(self) -> Abilities:
+        return Abilities({ability: float(value) for ability, value in zip(Ability, self.ability_vector)})
+
+    def __eq__(self, other):
+        return isinstance(other, Player) and self.pool is other.pool and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.pool), self.index))
 
     def __repr__(self):
         return '{name=%r, age=%d, abilities=%r}' % (
@@ -79,26 +163,52 @@ class Selection(dict):
         outfield_count = sum(position_counter[position]
                              for position in outfield_positions)
 
-        if outfield_count > 10:
-            raise ValueError('Cannot have more than %d in positions %s.' % (10, ','.join(position.name
-                                                                                         for position in
-                                                                                         outfield_positions)))
+        if outfield_count > max_outfield_players:
+            raise ValueError('Cannot have more than %d in positions %s.' % (max_outfield_players,
+                                                                            ','.join(position.name
+                                                                                     for position in
+                                                                                     outfield_positions)))
 
-        if position_counter[Position.GK] > 1:
-            raise ValueError('Cannot have more than %d in position %s.' % (1, Position.GK.name))
+        if position_counter[Position.GK] > max_goal_keepers:
+            raise ValueError('Cannot have more than %d in position %s.' % (max_goal_keepers, Position.GK.name))
 
         super().__init__(players)
 
         self.name = name
 
+        self._ability_matrix = None
+        self._position_matrix = None
+        self._position_ability_totals = None
+
     def __repr__(self):
         return self.__class__.__name__ + '(' + self.name + ': ' + super().__repr__() + ')'
 
     def total_ability(self, ability: Ability, position: Position) -> float:
-        players_at_position = {player: position for player, play_position in self.items() if play_position is position}
-        return math.sqrt(sum(map(lambda item: item[0].abilities[ability],
-                                 players_at_position.items())) * (
-                             goal_keeper_correction if position is Position.GK else 1.0))
+        return float(self.position_ability_totals()[position_indices[position], ability_indices[ability]])
+
+    def ability_matrix(self) -> np.ndarray:
+        # (players x abilities), rows in the iteration order of the selection.
+        if self._ability_matrix is None:
+            self._ability_matrix = np.array([player.ability_vector for player in self.keys()],
+                                            dtype=np.float64).reshape(-1, len(Ability))
+        return self._ability_matrix
+
+    def position_matrix(self) -> np.ndarray:
+        # (players x positions) one-hot, rows in the iteration order of the selection.
+        if self._position_matrix is None:
+            self._position_matrix = np.zeros(shape=(len(self), len(Position)), dtype=np.float64)
+            self._position_matrix[np.arange(len(self)), [position_indices[position]
+                                                         for position in self.values()]] = 1.0
+        return self._position_matrix
+
+    def position_ability_sums(self) -> np.ndarray:
+        return self.position_matrix().T @ self.ability_matrix()
+
+    def position_ability_totals(self) -> np.ndarray:
+        # (positions x abilities) of total_ability for every position and ability.
+        if self._position_ability_totals is None:
+            self._position_ability_totals = position_ability_totals(self.position_ability_sums())
+        return self._position_ability_totals
 
     def formation(self) -> Dict[Position, List[Player]]:
         f = defaultdict(list)
@@ -129,98 +239,182 @@ class Selection(dict):
         return Selection(name=self.name, players=players.items())
 
 
+class Assignments(NamedTuple):
+    # Selections as columns, one row per player: the index of the club in club_names, the player's row in a
+    # PlayerPool and the index of the player's position.
+    club_names: List[str]
+    clubs: np.ndarray
+    players: np.ndarray
+    positions: np.ndarray
+
+
+def selection_assignments(selections: Iterable[Selection], pool: PlayerPool) -> Assignments:
+    selections = list(selections)
+    for selection in selections:
+        for player in selection.keys():
+            if player.pool is not pool:
+                raise ValueError('Player is not from the pool. player=%r' % player)
+
+    return Assignments(club_names=[selection.name for selection in selections],
+                       clubs=np.array([club_index
+                                       for club_index, selection in enumerate(selections)
+                                       for player in selection.keys()], dtype=np.int32),
+                       players=np.array([player.index
+                                         for selection in selections
+                                         for player in selection.keys()], dtype=np.int64),
+                       positions=np.array([position_indices[position]
+                                           for selection in selections
+                                           for position in selection.values()], dtype=np.int8))
+
+
+def selections_from_assignments(assignments: Assignments, pool: PlayerPool) -> Dict[str, Selection]:
+    positions = list(Position)
+    players_by_club = defaultdict(list)
+    for club_index, player_index, position_index in zip(assignments.clubs.tolist(), assignments.players.tolist(),
+                                                        assignments.positions.tolist()):
+        players_by_club[club_index].append((pool[player_index], positions[position_index]))
+
+    return OrderedDict((club, Selection(name=club, players=players_by_club[club_index]))
+                       for club_index, club in enumerate(assignments.club_names))
+
+
 def logistic(x: float) -> float:
-    return 1.0 / (1.0 + math.exp(-x / 4))
+    return 1.0 / (1.0 + np.exp(-x / 4))
 
 
-def _calculate_team_probs(selection: Selection, other_selection: Selection) -> List[Tx]:
-    name = selection.name
-    other_name = other_selection.name
+def _coefficients(terms: List[Tuple[Ability, Position]]) -> np.ndarray:
+    c = np.zeros(shape=(len(Position), len(Ability)), dtype=np.float64)
+    for ability, position in terms:
+        c[position_indices[position], ability_indices[ability]] += 1.0
+    return c.ravel()
+
+
+# Each transition probability is the logistic of the team's own position abilities less those of the other team.
+# The order matches the transitions of _team_edges.
+_transition_terms = [
+    # GK pass to D
+    ([(Ability.PASSING, Position.GK), (Ability.BALL_WINNING, Position.D)],
+     [(Ability.BALL_WINNING, Position.F)]),
+
+    # GK pass to M
+    # ([(Ability.PASSING, Position.GK), (Ability.BALL_WINNING, Position.M)],
+    #  [(Ability.BALL_WINNING, Position.M)]),
 
-    gk_passing = selection.total_ability(Ability.PASSING, Position.GK)
-    d_passing = selection.total_ability(Ability.PASSING, Position.D)
-    m_passing = selection.total_ability(Ability.PASSING, Position.M)
-    f_passing = selection.total_ability(Ability.PASSING, Position.F)
+    # GK pass to F
+    # ([(Ability.PASSING, Position.GK), (Ability.BALL_WINNING, Position.F)],
+    #  [(Ability.BALL_WINNING, Position.D)]),
 
-    f_ball_winning = selection.total_ability(Ability.BALL_WINNING, Position.F)
-    m_ball_winning = selection.total_ability(Ability.BALL_WINNING, Position.M)
-    d_ball_winning = selection.total_ability(Ability.BALL_WINNING, Position.D)
+    # D pass to D
+    # ([(Ability.PASSING, Position.D), (Ability.DRIBBLING, Position.D), (Ability.BALL_WINNING, Position.D)],
+    #  [(Ability.BALL_WINNING, Position.F)]),
 
-    of_ball_winning = other_selection.total_ability(Ability.BALL_WINNING, Position.F)
-    om_ball_winning = other_selection.total_ability(Ability.BALL_WINNING, Position.M)
-    od_ball_winning = other_selection.total_ability(Ability.BALL_WINNING, Position.D)
+    # D pass to M
+    ([(Ability.PASSING, Position.D), (Ability.DRIBBLING, Position.D), (Ability.BALL_WINNING, Position.M)],
+     [(Ability.BALL_WINNING, Position.F)]),
 
-    d_dribbling = selection.total_ability(Ability.DRIBBLING, Position.D)
-    m_dribbling = selection.total_ability(Ability.DRIBBLING, Position.M)
-    f_dribbling = selection.total_ability(Ability.DRIBBLING, Position.F)
+    # M pass to M
+    # ([(Ability.PASSING, Position.M), (Ability.DRIBBLING, Position.M), (Ability.BALL_WINNING, Position.M)],
+    #  [(Ability.BALL_WINNING, Position.M)]),
 
-    m_shooting = selection.total_ability(Ability.SHOOTING, Position.M)
-    f_shooting = selection.total_ability(Ability.SHOOTING, Position.F)
+    # M pass to F
+    ([(Ability.PASSING, Position.M), (Ability.DRIBBLING, Position.M), (Ability.BALL_WINNING, Position.F)],
+     [(Ability.BALL_WINNING, Position.D)]),
 
-    om_blocking = other_selection.total_ability(Ability.BLOCKING, Position.M)
-    od_blocking = other_selection.total_ability(Ability.BLOCKING, Position.D)
-    ogk_blocking = other_selection.total_ability(Ability.BLOCKING, Position.GK)
+    # M shoots
+    ([(Ability.SHOOTING, Position.M), (Ability.DRIBBLING, Position.M)],
+     [(Ability.BLOCKING, Position.M), (Ability.BLOCKING, Position.D), (Ability.BLOCKING, Position.GK)]),
 
-    p_gk_d = logistic(gk_passing + d_ball_winning - of_ball_winning)
-    p_gk_m = logistic(gk_passing + m_ball_winning - om_ball_winning)
-    p_gk_f = logistic(gk_passing + f_ball_winning - od_ball_winning)
+    # F pass to F
+    # ([(Ability.PASSING, Position.F), (Ability.DRIBBLING, Position.F), (Ability.BALL_WINNING, Position.F)],
+    #  [(Ability.BALL_WINNING, Position.D)]),
 
-    p_d_d = logistic(d_passing + d_dribbling + d_ball_winning - of_ball_winning)
-    p_d_m = logistic(d_passing + d_dribbling + m_ball_winning - of_ball_winning)
+    # F shoots
+    ([(Ability.SHOOTING, Position.F), (Ability.DRIBBLING, Position.F)],
+     [(Ability.BLOCKING, Position.D), (Ability.BLOCKING, Position.GK)])
+]
 
-    p_m_m = logistic(m_passing + m_dribbling + m_ball_winning - om_ball_winning)
-    p_m_f = logistic(m_passing + m_dribbling + f_ball_winning - od_ball_winning)
-    p_m_sc = logistic(m_shooting + m_dribbling - om_blocking - od_blocking - ogk_blocking)
+_own_coefficients = np.stack([_coefficients(own) for own, other in _transition_terms])
+_other_coefficients = np.stack([_coefficients(other) for own, other in _transition_terms])
 
-    p_f_f = logistic(f_passing + f_dribbling + f_ball_winning - od_ball_winning)
-    p_f_sc = logistic(f_shooting + f_dribbling - od_blocking - ogk_blocking)
 
+def _team_edges(name, other_name) -> List[Tuple[S, S]]:
     return [
         # GK pass to D
-        Tx(S(name, TeamState.WITH_GK), S(name, TeamState.WITH_D), p_gk_d),
-        Tx(S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_F), 1.0 - p_gk_d),
+        (S(name, TeamState.WITH_GK), S(name, TeamState.WITH_D)),
+        (S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_F)),
 
         # GK pass to M
-        # Tx(S(name, TeamState.WITH_GK), S(name, TeamState.WITH_M), p_gk_m),
-        # Tx(S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_M), 1.0 - p_gk_m),
+        # (S(name, TeamState.WITH_GK), S(name, TeamState.WITH_M)),
+        # (S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_M)),
 
         # GK pass to F
-        # Tx(S(name, TeamState.WITH_GK), S(name, TeamState.WITH_F), p_gk_f),
-        # Tx(S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_D), 1.0 - p_gk_f),
+        # (S(name, TeamState.WITH_GK), S(name, TeamState.WITH_F)),
+        # (S(name, TeamState.WITH_GK), S(other_name, TeamState.WITH_D)),
 
         # D pass to D
-        # Tx(S(name, TeamState.WITH_D), S(name, TeamState.WITH_D), p_d_d),
-        # Tx(S(name, TeamState.WITH_D), S(other_name, TeamState.WITH_F), 1.0 - p_d_d),
+        # (S(name, TeamState.WITH_D), S(name, TeamState.WITH_D)),
+        # (S(name, TeamState.WITH_D), S(other_name, TeamState.WITH_F)),
 
         # D pass to M
-        Tx(S(name, TeamState.WITH_D), S(name, TeamState.WITH_M), p_d_m),
-        Tx(S(name, TeamState.WITH_D), S(other_name, TeamState.WITH_M), 1.0 - p_d_m),
+        (S(name, TeamState.WITH_D), S(name, TeamState.WITH_M)),
+        (S(name, TeamState.WITH_D), S(other_name, TeamState.WITH_M)),
 
         # M pass to M
-        # Tx(S(name, TeamState.WITH_M), S(name, TeamState.WITH_M), p_m_m),
-        # Tx(S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_M), 1.0 - p_m_m),
+        # (S(name, TeamState.WITH_M), S(name, TeamState.WITH_M)),
+        # (S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_M)),
 
         # M pass to F
-        Tx(S(name, TeamState.WITH_M), S(name, TeamState.WITH_F), p_m_f),
-        Tx(S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_D), 1.0 - p_m_f),
+        (S(name, TeamState.WITH_M), S(name, TeamState.WITH_F)),
+        (S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_D)),
 
         # M shoots
-        Tx(S(name, TeamState.WITH_M), S(name, TeamState.SCORED), p_m_sc),
-        Tx(S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_GK), 1.0 - p_m_sc),
+        (S(name, TeamState.WITH_M), S(name, TeamState.SCORED)),
+        (S(name, TeamState.WITH_M), S(other_name, TeamState.WITH_GK)),
 
         # F pass to F
-        # Tx(S(name, TeamState.WITH_F), S(name, TeamState.WITH_F), p_f_f),
-        # Tx(S(name, TeamState.WITH_F), S(other_name, TeamState.WITH_D), 1.0 - p_f_f),
+        # (S(name, TeamState.WITH_F), S(name, TeamState.WITH_F)),
+        # (S(name, TeamState.WITH_F), S(other_name, TeamState.WITH_D)),
 
         # F shoots
-        Tx(S(name, TeamState.WITH_F), S(name, TeamState.SCORED), p_f_sc),
-        Tx(S(name, TeamState.WITH_F), S(other_name, TeamState.WITH_GK), 1.0 - p_f_sc)
+        (S(name, TeamState.WITH_F), S(name, TeamState.SCORED)),
+        (S(name, TeamState.WITH_F), S(other_name, TeamState.WITH_GK))
     ]
 
 
+def _team_logits(totals: np.ndarray, other_totals: np.ndarray) -> np.ndarray:
+    # (..., positions, abilities) totals for each side to the (..., transitions) logits of the side's transitions,
+    # which are all that its part of the chain depends on.
+    batch_shape = totals.shape[:-2]
+    return (totals.reshape(batch_shape + (-1,)) @ _own_coefficients.T -
+            other_totals.reshape(batch_shape + (-1,)) @ _other_coefficients.T)
+
+
+def _team_weights(totals: np.ndarray, other_totals: np.ndarray) -> np.ndarray:
+    # (..., positions, abilities) totals for each side to (..., edges) weights for the edges of _team_edges,
+    # i.e. each transition probability followed by its complement.
+    p = logistic(_team_logits(totals, other_totals))
+    return np.stack((p, 1.0 - p), axis=-1).reshape(p.shape[:-1] + (-1,))
+
+
+def _pairing_weights(totals_1: np.ndarray, totals_2: np.ndarray) -> np.ndarray:
+    return np.concatenate((_team_weights(totals_1, totals_2), _team_weights(totals_2, totals_1)), axis=-1)
+
+
+def _calculate_team_probs(selection: Selection, other_selection: Selection) -> List[Tx]:
+    weights = _team_weights(selection.position_ability_totals(), other_selection.position_ability_totals())
+    return [Tx(s_from, s_to, float(weight))
+            for (s_from, s_to), weight in zip(_team_edges(selection.name, other_selection.name), weights)]
+
+
+# The chain topology is the same for every pairing, so it is compiled once with the two sides labelled 0 and 1.
+_chain_template = MarkovChainTemplate(_team_edges(0, 1) + _team_edges(1, 0))
+_scored_indices = [_chain_template.absorbing_states.index(S(side, TeamState.SCORED)) for side in (0, 1)]
+
+
 def calculate_markov_chain(selection_1: Selection, selection_2: Selection) -> MarkovChain:
-    return MarkovChain(_calculate_team_probs(selection=selection_1, other_selection=selection_2) +
-                       _calculate_team_probs(selection=selection_2, other_selection=selection_1))
+    weights = _pairing_weights(selection_1.position_ability_totals(), selection_2.position_ability_totals())
+    names = (selection_1.name, selection_2.name)
+    return _chain_template.create(weights, state_map=lambda s: S(names[s.team], s.team_state))
 
 
 def next_goal_probs(mc: MarkovChain,
@@ -229,3 +423,125 @@ def next_goal_probs(mc: MarkovChain,
     return mc.calculate_mean_outcome_given_states(states=(S(name, team_state)
                                                           for team_state in team_states
                                                           for name in names))
+
+
+def batch_next_goal_probs(totals_1: np.ndarray, totals_2: np.ndarray, team_states: Iterable[TeamState]) -> np.ndarray:
+    # Stacks of (..., positions, abilities) totals for each side to (..., 2) probabilities that side 1 and side 2
+    # score next, as next_goal_probs would give for calculate_markov_chain on each pairing, with one batched solve.
+    B = absorption_probabilities(_chain_template.transition_matrices(_pairing_weights(totals_1, totals_2)),
+                                 n_transient_states=len(_chain_template.transient_states))
+    start_indices = [_chain_template.state_indices[S(side, team_state)]
+                     for team_state in team_states
+                     for side in (0, 1)]
+    return B[..., start_indices, :][..., _scored_indices].mean(axis=-2)
+
+
+def batch_next_goal_gradients(totals_1: np.ndarray, totals_2: np.ndarray,
+                              team_states: Iterable[TeamState]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The (...) probabilities that side 1 scores next, as batch_next_goal_probs gives them, and their gradients with
+    # respect to the (..., positions, abilities) totals of side 1 and of side 2, through the absorption solve, the
+    # normalisation of each state's transitions and the logistic of each transition.
+    start_distribution = np.zeros(shape=len(_chain_template.transient_states), dtype=np.float64)
+    start_indices = [_chain_template.state_indices[S(side, team_state)]
+                     for team_state in team_states
+                     for side in (0, 1)]
+    np.add.at(start_distribution, start_indices, 1.0 / len(start_indices))
+
+    totals_1, totals_2 = np.broadcast_arrays(totals_1, totals_2)
+    weights = _pairing_weights(totals_1, totals_2)
+    probs, weight_gradients = _chain_template.absorption_gradients(weights, start_distribution=start_distribution,
+                                                                   absorbing_index=_scored_indices[0])
+
+    # Weights come in (p, 1 - p) pairs, p = logistic(x) and logistic'(x) = p (1 - p) / 4.
+    p = weights[..., 0::2]
+    x_gradients = (weight_gradients[..., 0::2] - weight_gradients[..., 1::2]) * p * (1.0 - p) / 4
+    n_transitions = len(_transition_terms)
+    x_gradients_1, x_gradients_2 = x_gradients[..., :n_transitions], x_gradients[..., n_transitions:]
+    gradients_1 = x_gradients_1 @ _own_coefficients - x_gradients_2 @ _other_coefficients
+    gradients_2 = x_gradients_2 @ _own_coefficients - x_gradients_1 @ _other_coefficients
+    return probs, gradients_1.reshape(totals_1.shape), gradients_2.reshape(totals_2.shape)
+
+
+class NextGoalCache(object):
+    # A bounded LRU cache of batch_next_goal_probs for each pairing, keyed by the bytes of both sides' transition
+    # logits, which are all that the chain depends on, rounded to decimals so that logits that differ only by rounding
+    # error share an entry, and by the team states. Lineups that differ only in their bench, or in abilities no
+    # transition uses, or that have not changed since the last solve, are then looked up rather than solved. A maxsize
+    # of 0 turns the cache off.
+    def __init__(self, maxsize: int = 1 << 16, decimals: int = 10):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries), maxsize=self.maxsize,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, maxsize: int):
+        self.maxsize = maxsize
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def _fingerprints(self, totals_1: np.ndarray, totals_2: np.ndarray,
+                      team_states: Tuple[TeamState, ...]) -> List[bytes]:
+        # One row per pairing of both sides' rounded logits followed by the team states. Adding 0.0 turns any -0.0
+        # from rounding into 0.0, which has different bytes.
+        n_logits = 2 * len(_transition_terms)
+        rows = np.empty(shape=(int(np.prod(totals_1.shape[:-2])), n_logits + len(team_states)))
+        rows[:, :n_logits] = np.concatenate((_team_logits(totals_1, totals_2), _team_logits(totals_2, totals_1)),
+                                            axis=-1).reshape(-1, n_logits)
+        np.round(rows[:, :n_logits], self.decimals, out=rows[:, :n_logits])
+        rows += 0.0
+        rows[:, n_logits:] = [team_state.value for team_state in team_states]
+        return rows.view(np.dtype((np.void, rows.shape[1] * rows.itemsize))).ravel().tolist()
+
+    def next_goal_probs(self, totals_1: np.ndarray, totals_2: np.ndarray,
+                        team_states: Iterable[TeamState]) -> np.ndarray:
+        # As batch_next_goal_probs, solving only the pairings that are not cached, in one batch.
+        team_states = tuple(team_states)
+        if self.maxsize <= 0:
+            return batch_next_goal_probs(totals_1=totals_1, totals_2=totals_2, team_states=team_states)
+
+        totals_1, totals_2 = np.broadcast_arrays(totals_1, totals_2)
+        keys = self._fingerprints(totals_1, totals_2, team_states)
+
+        entries = self._entries
+        values = [entries.get(key) for key in keys]
+        missing = {}
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, i)
+            else:
+                entries.move_to_end(key)
+        # A pairing repeated within the batch is solved once, and counts as a hit after the first.
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        if missing:
+            first_rows = list(missing.values())
+            solved = batch_next_goal_probs(totals_1=totals_1.reshape((-1,) + totals_1.shape[-2:])[first_rows],
+                                           totals_2=totals_2.reshape((-1,) + totals_2.shape[-2:])[first_rows],
+                                           team_states=team_states)
+            entries.update(zip(missing.keys(), map(tuple, solved.tolist())))
+            values = [entries[key] if value is None else value for key, value in zip(keys, values)]
+            self._evict()
+
+        return np.array(values).reshape(totals_1.shape[:-2] + (2,))
+
+
+# Shared by evaluate_selection and next_goal_matrix. Use resize to change its size.
+next_goal_cache = NextGoalCache()
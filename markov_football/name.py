@@ -1,28 +1,67 @@
 import csv
 import os
+import tempfile
 from typing import Iterable, Tuple, List, Dict
-from numpy import random
+import numpy as np
 from collections import OrderedDict
 
 
+def _load_names(file_name: str) -> np.ndarray:
+    # The first column of a census CSV in names/, cached as a .npy file next to it so that later runs skip the parse.
+    csv_path = os.path.join(os.path.dirname(__file__), '..', 'names', file_name)
+    cache_path = os.path.splitext(csv_path)[0] + '.npy'
+
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+            return np.load(cache_path, allow_pickle=False)
+    except (OSError, ValueError):
+        pass
+
+    with open(csv_path) as file:
+        r = csv.reader(file, delimiter=',')
+        names = np.array([name for name, *rest in r], dtype=np.str_)
+
+    # Each process writes its own temporary file, so that workers starting cold at once cannot interleave their
+    # writes before the rename.
+    temporary_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), suffix='.npy.tmp', delete=False) as file:
+            temporary_path = file.name
+            np.save(file, names, allow_pickle=False)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        if temporary_path is not None and os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    return names
+
+
 class NamesGenerator(object):
     _first_names = None
     _last_names = None
 
     @staticmethod
-    def names(n: int) -> Iterable[Tuple[str, str]]:
-        if not NamesGenerator._first_names:
-            with open(os.path.join(os.path.dirname(__file__), '..', 'names', 'census-dist-male-first.csv')) as file:
-                r = csv.reader(file, delimiter=',')
-                NamesGenerator._first_names = [name for name, *rest in r]
-
-        if not NamesGenerator._last_names:
-            with open(os.path.join(os.path.dirname(__file__), '..', 'names', 'census-dist-2500-last.csv')) as file:
-                r = csv.reader(file, delimiter=',')
-                NamesGenerator._last_names = [name for name, *rest in r]
-
-        for i in range(n):
-            yield (random.choice(NamesGenerator._first_names), random.choice(NamesGenerator._last_names))
+    def tables() -> Tuple[np.ndarray, np.ndarray]:
+        if NamesGenerator._first_names is None:
+            NamesGenerator._first_names = _load_names('census-dist-male-first.csv')
+
+        if NamesGenerator._last_names is None:
+            NamesGenerator._last_names = _load_names('census-dist-2500-last.csv')
+
+        return NamesGenerator._first_names, NamesGenerator._last_names
+
+    @staticmethod
+    def name_indices(n: int, rng: np.random.Generator = None) -> np.ndarray:
+        # An (n x 2) array of indices into the first and last name tables, drawn at once.
+        first_names, last_names = NamesGenerator.tables()
+        return np.random.default_rng(rng).integers([len(first_names), len(last_names)], size=(n, 2),
+                                                   dtype=np.int32)
+
+    @staticmethod
+    def names(n: int, rng: np.random.Generator = None) -> Iterable[Tuple[str, str]]:
+        first_names, last_names = NamesGenerator.tables()
+        for first_index, last_index in NamesGenerator.name_indices(n=n, rng=rng):
+            yield (str(first_names[first_index]), str(last_names[last_index]))
 
 
 def football_clubs_by_league() -> Dict[str, List[str]]:
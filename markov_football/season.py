@@ -0,0 +1,73 @@
+from .util import *
+
+
+class SeasonSummary(NamedTuple):
+    names: List[str]
+    # position_counts[i, k] is the number of replicas in which names[i] finished in position k, from the top.
+    position_counts: np.ndarray
+    expected_points: np.ndarray
+    expected_goal_difference: np.ndarray
+    title_probability: np.ndarray
+    relegation_probability: np.ndarray
+
+    @property
+    def position_probabilities(self) -> np.ndarray:
+        return self.position_counts / self.position_counts.sum(axis=1, keepdims=True)
+
+
+def season_pairings(names: Iterable[str]) -> List[Tuple[str, str]]:
+    return [(club_1, club_2)
+            for fixtures_this_week in fixtures(names)
+            for club_1, club_2 in fixtures_this_week
+            if club_1 and club_2]
+
+
+def simulate_seasons(selections_by_name: Dict[str, Selection], replicas: int, relegation_places: int = 3,
+                     steps: int = 100, rng: np.random.Generator = None) -> SeasonSummary:
+    # Plays replicas independent seasons of fixtures with the selections kept as they are. Each pairing's chain and
+    # exact scoreline distribution are computed once, and all replicas of its match are drawn from that
+    # distribution. Clubs are ranked as in the weekly table, by points, then goal difference, then goals, and clubs
+    # level on all three are ordered at random rather than by where they are listed.
+    # Replica r draws all of its matches, and then its tie-break, from the r-th child stream spawned from rng, so any
+    # replica can be replayed on its own.
+    names = list(selections_by_name.keys())
+    indices = {name: i for i, name in enumerate(names)}
+    n = len(names)
+    pairings = season_pairings(names)
+
+    replica_rngs = np.random.default_rng(rng).spawn(replicas)
+    uniforms = np.stack([replica_rng.random(len(pairings)) for replica_rng in replica_rngs], axis=1)
+    tie_breaks = np.stack([replica_rng.random(n) for replica_rng in replica_rngs])
+
+    points = np.zeros(shape=(replicas, n), dtype=np.int64)
+    goals = np.zeros(shape=(replicas, n), dtype=np.int64)
+    conceded_goals = np.zeros(shape=(replicas, n), dtype=np.int64)
+
+    for (club_1, club_2), pairing_uniforms in zip(pairings, uniforms):
+        mc = calculate_markov_chain(selection_1=selections_by_name[club_1], selection_2=selections_by_name[club_2])
+        scorelines = scorelines_from_uniforms(outcome=match_outcome(mc=mc, name_1=club_1, name_2=club_2, steps=steps),
+                                              uniforms=pairing_uniforms)
+        goals_1, goals_2 = scorelines[:, 0], scorelines[:, 1]
+        i, j = indices[club_1], indices[club_2]
+
+        goals[:, i] += goals_1
+        goals[:, j] += goals_2
+        conceded_goals[:, i] += goals_2
+        conceded_goals[:, j] += goals_1
+        points[:, i] += np.where(goals_1 > goals_2, 3, np.where(goals_1 == goals_2, 1, 0))
+        points[:, j] += np.where(goals_2 > goals_1, 3, np.where(goals_1 == goals_2, 1, 0))
+
+    goal_difference = goals - conceded_goals
+
+    # The last key is the primary one, so each row lists club indices from the top of the table down.
+    order = np.lexsort((tie_breaks, -goals, -goal_difference, -points), axis=-1)
+
+    position_counts = np.zeros(shape=(n, n), dtype=np.int64)
+    np.add.at(position_counts, (order, np.broadcast_to(np.arange(n), order.shape)), 1)
+
+    return SeasonSummary(names=names,
+                         position_counts=position_counts,
+                         expected_points=points.mean(axis=0),
+                         expected_goal_difference=goal_difference.mean(axis=0),
+                         title_probability=position_counts[:, 0] / replicas,
+                         relegation_probability=position_counts[:, n - relegation_places:].sum(axis=1) / replicas)
@@ -0,0 +1,133 @@
+from .markov_football import *
+from typing import Optional
+import csv
+import os
+import queue
+import threading
+
+# Results leave the simulation as events sent to a ResultSink, so how, and whether, they are reported is chosen by
+# whoever runs it. hold_week and play_season only build events for a sink that is not silent.
+
+
+class FixtureResult(NamedTuple):
+    week: Optional[int]
+    club_1: str
+    club_2: str
+    selection_1: Selection
+    selection_2: Selection
+    # Expected goals and W/D/L probabilities for an expected fixture, otherwise the sampled score and 0s and 1s.
+    goals_1: float
+    goals_2: float
+    win_1: float
+    draw: float
+    win_2: float
+    expected: bool
+
+
+class LineupChange(NamedTuple):
+    # A player whose position differs from the one in their club's previous selection, None if they were not in it.
+    week: Optional[int]
+    club: str
+    player: Tuple[str, str]
+    from_position: Optional[Position]
+    to_position: Position
+
+
+class WeekTable(NamedTuple):
+    week: int
+    table: 'LeagueTable'
+
+
+class ResultSink(object):
+    silent = False
+
+    def emit(self, event: NamedTuple):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'ResultSink':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullSink(ResultSink):
+    silent = True
+
+    def emit(self, event: NamedTuple):
+        pass
+
+
+def is_silent(sink: Optional[ResultSink]) -> bool:
+    return sink is None or sink.silent
+
+
+class CsvSink(ResultSink):
+    # Writes fixtures.csv, lineups.csv and tables.csv in directory from a background thread, so that formatting and
+    # file I/O overlap the simulation. Events are queued as they are and only turned into rows on that thread.
+    _columns = OrderedDict([
+        (FixtureResult, ('fixtures', ['week', 'club_1', 'club_2', 'goals_1', 'goals_2', 'win_1', 'draw', 'win_2',
+                                      'expected'])),
+        (LineupChange, ('lineups', ['week', 'club', 'first_name', 'last_name', 'from_position', 'to_position'])),
+        (WeekTable, ('tables', ['week', 'club', 'p', 'w', 'd', 'l', 'g', 'c'])),
+    ])
+
+    def __init__(self, directory: str, max_queued: int = 10000):
+        os.makedirs(directory, exist_ok=True)
+        self._files = {}
+        self._writers = {}
+        for event_type, (file_name, header) in self._columns.items():
+            self._files[event_type] = open(os.path.join(directory, file_name + '.csv'), 'w', newline='',
+                                           buffering=1 << 16)
+            self._writers[event_type] = csv.writer(self._files[event_type])
+            self._writers[event_type].writerow(header)
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, name='CsvSink', daemon=True)
+        self._thread.start()
+
+    def emit(self, event: NamedTuple):
+        if self._error:
+            raise RuntimeError('Writing results failed.') from self._error
+        self._queue.put(event)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for file in self._files.values():
+            file.close()
+        if self._error:
+            raise RuntimeError('Writing results failed.') from self._error
+
+    def _write(self):
+        # After a failed write, later events are taken off the queue and dropped until close, so that emit never
+        # blocks on a full queue and raises the error instead.
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            if self._error:
+                continue
+            try:
+                self._writers[type(event)].writerows(self._rows(event))
+            except Exception as error:
+                self._error = error
+
+    @staticmethod
+    def _rows(event: NamedTuple) -> Iterable[list]:
+        if isinstance(event, FixtureResult):
+            return [[event.week, event.club_1, event.club_2, event.goals_1, event.goals_2, event.win_1, event.draw,
+                     event.win_2, int(event.expected)]]
+        if isinstance(event, LineupChange):
+            return [[event.week, event.club, event.player[0], event.player[1],
+                     event.from_position.name if event.from_position else '', event.to_position.name]]
+        table = event.table
+        return [[event.week, name, p, w, d, l, g, c]
+                for name, p, w, d, l, g, c in zip(table.names, table.points.tolist(), table.wins.tolist(),
+                                                  table.draws.tolist(), table.losses.tolist(), table.goals.tolist(),
+                                                  table.conceded_goals.tolist())]
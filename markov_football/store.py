@@ -0,0 +1,86 @@
+from .markov_football import *
+import json
+import os
+
+# A store is a directory with one .npy file per column and a header.json, which is written last, recording the kind
+# of store, its format version and any other metadata. Columns are opened memory-mapped, so that a large population
+# opens in constant time and processes reading the same store share its pages.
+
+store_version = 1
+
+_header_file_name = 'header.json'
+
+
+def _write_store(path: str, kind: str, columns: Dict[str, np.ndarray], **metadata):
+    os.makedirs(path, exist_ok=True)
+
+    header_path = os.path.join(path, _header_file_name)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+    for column, array in columns.items():
+        np.save(os.path.join(path, column + '.npy'), np.ascontiguousarray(array), allow_pickle=False)
+
+    header = dict(kind=kind, version=store_version, columns=list(columns), **metadata)
+    with open(header_path + '.tmp', 'w') as file:
+        json.dump(header, file)
+    os.replace(header_path + '.tmp', header_path)
+
+
+def _read_store(path: str, kind: str, mmap: bool = True) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    header_path = os.path.join(path, _header_file_name)
+    if not os.path.exists(header_path):
+        raise ValueError('Not a complete store. path=%s' % path)
+
+    with open(header_path) as file:
+        header = json.load(file)
+
+    if header.get('kind') != kind:
+        raise ValueError('Expected a %s store. kind=%r' % (kind, header.get('kind')))
+    if header.get('version') != store_version:
+        raise ValueError('Unsupported store version. version=%r' % header.get('version'))
+
+    columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r' if mmap else None,
+                               allow_pickle=False)
+               for column in header['columns']}
+    return header, columns
+
+
+def save_player_pool(path: str, pool: PlayerPool):
+    _write_store(path, 'player_pool',
+                 columns=dict(ages=pool.ages,
+                              first_name_indices=pool.first_name_indices,
+                              last_name_indices=pool.last_name_indices,
+                              abilities=pool.abilities,
+                              first_names=np.asarray(pool.first_names, dtype=np.str_),
+                              last_names=np.asarray(pool.last_names, dtype=np.str_)),
+                 abilities=[ability.name for ability in Ability])
+
+
+def load_player_pool(path: str, mmap: bool = True) -> PlayerPool:
+    header, columns = _read_store(path, 'player_pool', mmap=mmap)
+    if header['abilities'] != [ability.name for ability in Ability]:
+        raise ValueError('Stored abilities do not match. abilities=%r' % header['abilities'])
+    return PlayerPool(**columns)
+
+
+def save_selections(path: str, selections: Iterable[Selection], pool: PlayerPool):
+    # Stores one row per (club, player, position) assignment, referring to players by their row in pool.
+    assignments = selection_assignments(selections=selections, pool=pool)
+    _write_store(path, 'selections',
+                 columns=dict(clubs=assignments.clubs,
+                              players=assignments.players,
+                              positions=assignments.positions),
+                 club_names=assignments.club_names,
+                 pool_size=len(pool))
+
+
+def load_selections(path: str, pool: PlayerPool) -> Dict[str, Selection]:
+    header, columns = _read_store(path, 'selections')
+    if header['pool_size'] != len(pool):
+        raise ValueError('Selections were saved with a pool of %d players, not %d.' % (header['pool_size'], len(pool)))
+    return selections_from_assignments(assignments=Assignments(club_names=header['club_names'], **columns), pool=pool)
+
+
+def has_store(path: str) -> bool:
+    return os.path.exists(os.path.join(path, _header_file_name))
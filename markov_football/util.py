@@ -1,26 +1,51 @@
 from .markov_football import *
+from .sink import *
+from . import instrument
 from collections import deque
 from itertools import islice
+from typing import Callable
+from concurrent.futures import Executor
+import logging
 
+logger = logging.getLogger(__name__)
 
-def generate_random_player_population(n: int = 1) -> Iterable[Player]:
-    ng = NamesGenerator.names(n=n)
-    multiplier = np.random.uniform(0.0, 2.0)
-    for i in range(n):
-        abilities = Abilities(
-            {ability: multiplier * value for ability, value in zip(Ability, np.random.uniform(low=0.0, high=1.0,
-                                                                                              size=len(Ability)))})
-        player = Player(name=next(ng), age=16, abilities=abilities)
-        yield player
 
+def generate_random_player_pool(n: int = 1, rng: np.random.Generator = None, club_size: int = None) -> PlayerPool:
+    # Abilities are uniform on [0, multiplier), with one multiplier, uniform on [0, 2), for each consecutive block of
+    # club_size players, or for all of them without a club_size.
+    rng = np.random.default_rng(rng)
+    first_names, last_names = NamesGenerator.tables()
+    name_indices = NamesGenerator.name_indices(n=n, rng=rng)
+    n_clubs = -(-n // club_size) if club_size else 1
+    multipliers = np.repeat(rng.uniform(0.0, 2.0, size=n_clubs), club_size or n)[:n]
+    abilities = multipliers[:, np.newaxis] * rng.uniform(low=0.0, high=1.0, size=(n, len(Ability)))
+    return PlayerPool(ages=np.full(n, 16),
+                      first_name_indices=name_indices[:, 0],
+                      last_name_indices=name_indices[:, 1],
+                      abilities=abilities,
+                      first_names=first_names,
+                      last_names=last_names)
 
-def generate_typical_player_population(n: int = 1, typical: float = 0.5) -> Iterable[Player]:
-    ng = NamesGenerator.names(n=n)
-    for i in range(n):
-        abilities = Abilities(
-            {ability: typical for ability in Ability})
-        player = Player(name=next(ng), age=16, abilities=abilities)
-        yield player
+
+def generate_typical_player_pool(n: int = 1, typical: float = 0.5, rng: np.random.Generator = None) -> PlayerPool:
+    rng = np.random.default_rng(rng)
+    first_names, last_names = NamesGenerator.tables()
+    name_indices = NamesGenerator.name_indices(n=n, rng=rng)
+    return PlayerPool(ages=np.full(n, 16),
+                      first_name_indices=name_indices[:, 0],
+                      last_name_indices=name_indices[:, 1],
+                      abilities=np.full(shape=(n, len(Ability)), fill_value=typical),
+                      first_names=first_names,
+                      last_names=last_names)
+
+
+def generate_random_player_population(n: int = 1, rng: np.random.Generator = None) -> Iterable[Player]:
+    return iter(generate_random_player_pool(n=n, rng=rng))
+
+
+def generate_typical_player_population(n: int = 1, typical: float = 0.5,
+                                       rng: np.random.Generator = None) -> Iterable[Player]:
+    return iter(generate_typical_player_pool(n=n, typical=typical, rng=rng))
 
 
 def create_selection(name: str, players: Iterable[Player]) -> Selection:
@@ -35,103 +60,375 @@ def create_selection(name: str, players: Iterable[Player]) -> Selection:
 def optmise_player_positions_in_parrallel(
         selections: Iterable[Selection],
         team_states: Iterable[TeamState],
-        max_cycles_without_improvement: int = 100) -> Iterable[Selection]:
-    local_selections_by_name = {selection.name: selection for selection in selections}
+        max_cycles_without_improvement: int = 100,
+        league_strength: 'LeagueStrength' = None,
+        rng: np.random.Generator = None) -> Iterable[Selection]:
+    rng = np.random.default_rng(rng)
+    selections = list(selections)
+    if league_strength is None:
+        league_strength = LeagueStrength(selections=selections, team_states=team_states)
+    else:
+        league_strength.update(selections)
     names = [selection.name for selection in selections]
+    lineups_by_name = {name: _Lineup(league_strength[name]) for name in names}
 
     cycles_without_improvement = 0
 
     while cycles_without_improvement < max_cycles_without_improvement:
 
         for name in names:
-            selection = local_selections_by_name[name]
+            lineup = lineups_by_name[name]
 
-            next_goal_p = sum(
-                evaluate_selection(selection=selection,
-                                   reference_selections=local_selections_by_name.values(),
-                                   team_states=team_states)) / len(local_selections_by_name)
+            next_goal_p = league_strength.score(name)
 
-            trial_next_goal_p, trial_selection, description = _experiment_with_positioning(selection=selection,
-                                                                                           reference_selections=local_selections_by_name.values(),
-                                                                                           team_states=team_states)
+            trial_next_goal_p, moves, description = _experiment_with_positioning(
+                lineup=lineup,
+                league_strength=league_strength,
+                rng=rng)
 
-            if not trial_selection:
+            if not moves:
                 continue
             elif trial_next_goal_p > next_goal_p:
-                local_selections_by_name[name] = trial_selection
+                trial_selection = lineup.materialise(moves)
+                league_strength.update([trial_selection])
+                lineups_by_name[name] = _Lineup(trial_selection)
+                instrument.count('positioning.accepted')
                 logger.info('Change by %s: %s' % (name, description))
                 cycles_without_improvement = 0
         cycles_without_improvement += 1
     for name in names:
-        yield local_selections_by_name[name]
-
-
-def _experiment_with_positioning(selection: Selection,
-                                 reference_selections: Iterable[Selection],
-                                 team_states: Iterable[TeamState]) -> Tuple[float, Selection, str]:
-    if np.random.choice(a=[True, False]):
-        player = np.random.choice(a=list(selection.keys()))
-        old_position = selection[player]
-        new_position = np.random.choice(a=[pos for pos in Position if pos is not old_position])
-        description = 'Move %s from %s to %s.' % (str(player.name), old_position.name, new_position.name)
-        try:
-            new_selection = selection.with_player_positions(player_positions=[(player, new_position)])
-        except:
-            return (0, None, description)
+        yield league_strength[name]
+
+
+_positions = list(Position)
+
+
+class _Lineup(object):
+    # Running per-position ability sums and counts of a selection, so that trial moves are applied as deltas and
+    # a new Selection is only built for an accepted trial.
+    def __init__(self, selection: Selection):
+        self.selection = selection
+        self.players = list(selection.keys())
+        self.abilities = selection.ability_matrix()
+        self.positions = np.array([position_indices[position] for position in selection.values()], dtype=np.intp)
+        self.sums = selection.position_ability_sums()
+        self.counts = np.bincount(self.positions, minlength=len(Position))
+
+    def trial_totals(self, moves: List[Tuple[int, int]]) -> np.ndarray:
+        # moves are (player index, position index) pairs. Returns None for an invalid formation.
+        counts = self.counts.copy()
+        sums = self.sums.copy()
+        for player_index, position_index in moves:
+            old_position_index = self.positions[player_index]
+            counts[old_position_index] -= 1
+            counts[position_index] += 1
+            sums[old_position_index] -= self.abilities[player_index]
+            sums[position_index] += self.abilities[player_index]
+
+        if not position_counts_are_valid(counts):
+            return None
+        return position_ability_totals(np.maximum(sums, 0.0))
+
+    def neighbourhood(self) -> Tuple[List[List[Tuple[int, int]]], np.ndarray]:
+        # Every valid move of one player to another position and every swap of two players in different positions,
+        # with the (candidates x positions x abilities) totals each would give.
+        n_positions = len(Position)
+        eye = np.identity(n_positions)
+
+        move_players, move_positions = np.nonzero(self.positions[:, np.newaxis] != np.arange(n_positions))
+        move_deltas = eye[move_positions] - eye[self.positions[move_players]]
+        valid = position_counts_are_valid(self.counts + move_deltas)
+        move_players, move_positions, move_deltas = move_players[valid], move_positions[valid], move_deltas[valid]
+        move_sums = self.sums + move_deltas[:, :, np.newaxis] * self.abilities[move_players][:, np.newaxis, :]
+
+        swap_players_1, swap_players_2 = np.triu_indices(len(self.players), k=1)
+        differ = self.positions[swap_players_1] != self.positions[swap_players_2]
+        swap_players_1, swap_players_2 = swap_players_1[differ], swap_players_2[differ]
+        swap_deltas = eye[self.positions[swap_players_2]] - eye[self.positions[swap_players_1]]
+        swap_sums = self.sums + swap_deltas[:, :, np.newaxis] * (self.abilities[swap_players_1] -
+                                                                 self.abilities[swap_players_2])[:, np.newaxis, :]
+
+        candidates = [[(int(player), int(position))] for player, position in zip(move_players, move_positions)]
+        candidates += [[(int(player_1), int(self.positions[player_2])), (int(player_2), int(self.positions[player_1]))]
+                       for player_1, player_2 in zip(swap_players_1, swap_players_2)]
+
+        sums = np.concatenate((move_sums, swap_sums))
+        return candidates, position_ability_totals(np.maximum(sums, 0.0))
+
+    def describe(self, moves: List[Tuple[int, int]]) -> str:
+        if len(moves) == 1:
+            (player_index, position_index), = moves
+            return 'Move %s from %s to %s.' % (str(self.players[player_index].name),
+                                               _positions[self.positions[player_index]].name,
+                                               _positions[position_index].name)
+        (player_index_1, position_index_2), (player_index_2, position_index_1) = moves
+        return 'Swap %s in %s for %s in %s.' % (str(self.players[player_index_1].name),
+                                                _positions[position_index_1].name,
+                                                str(self.players[player_index_2].name),
+                                                _positions[position_index_2].name)
+
+    def materialise(self, moves: List[Tuple[int, int]]) -> Selection:
+        return self.selection.with_player_positions(player_positions=[(self.players[player_index],
+                                                                       _positions[position_index])
+                                                                      for player_index, position_index in moves])
+
+
+@instrument.timed('positioning.trial')
+def _experiment_with_positioning(lineup: _Lineup,
+                                 league_strength: 'LeagueStrength',
+                                 rng: np.random.Generator) -> Tuple[float, List[Tuple[int, int]], str]:
+    players = lineup.players
+    if rng.integers(2):
+        player_index = rng.integers(len(players))
+        old_position = _positions[lineup.positions[player_index]]
+        new_position = [pos for pos in Position if pos is not old_position][rng.integers(len(Position) - 1)]
+        description = 'Move %s from %s to %s.' % (str(players[player_index].name), old_position.name,
+                                                  new_position.name)
+        moves = [(player_index, position_indices[new_position])]
     else:
-        player1, player2 = np.random.choice(a=list(selection.keys()),
-                                            size=2,
-                                            replace=False)
-        position1, position2 = selection[player1], selection[player2]
+        player_index_1, player_index_2 = rng.choice(len(players), size=2, replace=False)
+        position_index_1, position_index_2 = lineup.positions[player_index_1], lineup.positions[player_index_2]
         description = 'Swap %s in %s for %s in %s.' % (
-            str(player1.name), position1.name, str(player2.name), position2.name)
-        if position1 is position2:
-            return (0, None, description)
-        try:
-            new_selection = selection.with_player_positions(
-                player_positions=[(player1, position2), (player2, position1)])
-        except:
+            str(players[player_index_1].name), _positions[position_index_1].name,
+            str(players[player_index_2].name), _positions[position_index_2].name)
+        if position_index_1 == position_index_2:
+            instrument.count('positioning.same_position')
             return (0, None, description)
+        moves = [(player_index_1, position_index_2), (player_index_2, position_index_1)]
+
+    totals = lineup.trial_totals(moves)
+    if totals is None:
+        instrument.count('positioning.invalid')
+        return (0, None, description)
+
+    return league_strength.trial_score(lineup.selection.name, totals), moves, description
+
 
-    next_goal_probs = list(evaluate_selection(selection=new_selection,
-                                              reference_selections=reference_selections,
-                                              team_states=team_states))
+def optimise_player_positions_by_neighbourhood(
+        selections: Iterable[Selection],
+        team_states: Iterable[TeamState],
+        temperature: float = 0.0,
+        cooling: float = 0.9,
+        min_temperature: float = 1e-4,
+        max_rounds: int = 1000,
+        league_strength: 'LeagueStrength' = None,
+        rng: np.random.Generator = None) -> Iterable[Selection]:
+    # Each round, every club in turn scores its whole neighbourhood in one batch and takes the best improving
+    # candidate. While temperature is at least min_temperature a candidate is instead sampled with probability
+    # proportional to exp(improvement / temperature), and the temperature is multiplied by cooling after each round.
+    # Converges when a round at zero temperature leaves every club unchanged. As clubs optimise against each other,
+    # the zero-temperature rounds can also cycle, in which case it stops when the lineups of every club repeat.
+    rng = np.random.default_rng(rng)
+    selections = list(selections)
+    if league_strength is None:
+        league_strength = LeagueStrength(selections=selections, team_states=team_states)
+    else:
+        league_strength.update(selections)
+    names = [selection.name for selection in selections]
+    seen_lineups = set()
+
+    for round_index in range(max_rounds):
+        annealing = temperature >= min_temperature
+        changed = False
+
+        for name in names:
+            lineup = _Lineup(league_strength[name])
+            candidates, totals = lineup.neighbourhood()
+            if not candidates:
+                continue
+
+            improvements = league_strength.trial_scores(name, totals) - league_strength.score(name)
+            instrument.count('neighbourhood.candidates', len(candidates))
+
+            if annealing:
+                weights = np.exp((improvements - improvements.max()) / temperature)
+                best = rng.choice(len(candidates), p=weights / weights.sum())
+            else:
+                best = int(np.argmax(improvements))
+                if improvements[best] <= 0:
+                    continue
+
+            league_strength.update([lineup.materialise(candidates[best])])
+            instrument.count('neighbourhood.accepted')
+            logger.info('Change by %s: %s' % (name, lineup.describe(candidates[best])))
+            changed = True
+
+        if not changed and not annealing:
+            logger.info('Converged after %d rounds.' % (round_index + 1))
+            break
+        if not annealing:
+            lineups = tuple(tuple(position_indices[position] for position in league_strength[name].values())
+                            for name in names)
+            if lineups in seen_lineups:
+                logger.info('Cycled after %d rounds.' % (round_index + 1))
+                break
+            seen_lineups.add(lineups)
+        temperature *= cooling
+    else:
+        logger.warning('Did not converge in %d rounds.' % max_rounds)
 
-    new_next_goal_prob = sum(next_goal_probs) / len(next_goal_probs)
-    return new_next_goal_prob, new_selection, description
+    for name in names:
+        yield league_strength[name]
 
 
+@instrument.timed('evaluate_selection')
 def evaluate_selection(
         selection: Selection,
         reference_selections: Iterable[Selection],
         team_states: Iterable[TeamState]) -> Iterable[float]:
+    reference_selections = list(reference_selections)
+    others = [reference_selection for reference_selection in reference_selections
+              if reference_selection.name != selection.name]
+
+    if others:
+        totals = selection.position_ability_totals()
+        other_totals = np.stack([other.position_ability_totals() for other in others])
+        probs = iter(next_goal_cache.next_goal_probs(totals_1=np.broadcast_to(totals, other_totals.shape),
+                                                      totals_2=other_totals,
+                                                      team_states=team_states)[:, 0])
+
     for reference_selection in reference_selections:
-        if reference_selection.name is selection.name:
+        if reference_selection.name == selection.name:
             yield 0.5
             continue
+        yield float(next(probs))
 
-        ngps = next_goal_probs(mc=calculate_markov_chain(selection_1=selection,
-                                                         selection_2=reference_selection),
-                               team_states=team_states)
-        next_goal_prob = ngps[S(selection.name, TeamState.SCORED)]
-        yield next_goal_prob
 
+class Sensitivities(NamedTuple):
+    # score is the mean probability of scoring next against each of the other selections, and the rest are its
+    # gradients: with respect to the (positions x abilities) totals and sums of the selection, and, for each player,
+    # the first-order change in score from moving them from their position to each position, in Position order.
+    score: float
+    totals: np.ndarray
+    sums: np.ndarray
+    players: List[Player]
+    placements: np.ndarray
 
-def create_next_goal_matrix(selections: List[Selection], team_states: Iterable[TeamState]) -> pd.DataFrame:
-    names = [selection.name for selection in selections]
-    n = len(names)
-    A = np.zeros(shape=(n, n))
 
-    mean_probability_other_selection = list()
+def selection_sensitivities(
+        selection: Selection,
+        reference_selections: Iterable[Selection],
+        team_states: Iterable[TeamState]) -> Sensitivities:
+    # One batched solve against the other selections gives every placement's first-order effect, without trying any
+    # of them. Placements ignore whether the formation they make is valid.
+    others = [reference_selection for reference_selection in reference_selections
+              if reference_selection.name != selection.name]
+    if not others:
+        raise ValueError('Need another selection to play against.')
+
+    totals = selection.position_ability_totals()
+    other_totals = np.stack([other.position_ability_totals() for other in others])
+    probs, totals_gradients, other_gradients = batch_next_goal_gradients(
+        totals_1=np.broadcast_to(totals, other_totals.shape), totals_2=other_totals, team_states=team_states)
+    totals_gradient = totals_gradients.mean(axis=0)
+    sums_gradient = position_ability_sum_gradients(selection.position_ability_sums(), totals_gradient)
+
+    # Moving a player with abilities v from position a to position b adds v to the sums of b and takes it from a.
+    gains_by_position = selection.ability_matrix() @ sums_gradient.T
+    with np.errstate(invalid='ignore'):
+        placements = gains_by_position - (gains_by_position * selection.position_matrix()).sum(axis=1, keepdims=True)
+    placements[selection.position_matrix() == 1.0] = 0.0
+
+    return Sensitivities(score=float(probs.mean()),
+                         totals=totals_gradient,
+                         sums=sums_gradient,
+                         players=list(selection.keys()),
+                         placements=placements)
+
+
+def next_goal_matrix(selections: List[Selection], team_states: Iterable[TeamState]) -> np.ndarray:
+    # A[i, j] is the probability that selections[i] scores next against selections[j]. Each pairing is solved
+    # once, for the upper triangle, and fills both of its cells.
+    totals = np.stack([selection.position_ability_totals() for selection in selections])
+    n = len(totals)
+
+    A = np.full(shape=(n, n), fill_value=0.5)
+    rows, cols = np.triu_indices(n, k=1)
+    if len(rows):
+        probs = next_goal_cache.next_goal_probs(totals_1=totals[rows], totals_2=totals[cols], team_states=team_states)
+        A[rows, cols] = probs[:, 0]
+        A[cols, rows] = probs[:, 1]
+    return A
+
+
+class LeagueStrength(object):
+    # Keeps the next_goal_matrix of a league, keyed by the identity of each club's current selection, so that a
+    # change of selection only re-solves that club's row and column. Trials are solved without next_goal_cache, as
+    # most of them are new totals, which cost more to look up and miss than to solve.
+    def __init__(self, selections: Iterable[Selection], team_states: Iterable[TeamState]):
+        self.team_states = list(team_states)
+        self._selections = OrderedDict((selection.name, selection) for selection in selections)
+        self._indices = {name: i for i, name in enumerate(self._selections)}
+        self._totals = np.stack([selection.position_ability_totals() for selection in self._selections.values()])
+        self.matrix = next_goal_matrix(selections=list(self._selections.values()), team_states=self.team_states)
+        self._scores = self.matrix.mean(axis=1)
+
+    def __getitem__(self, name: str) -> Selection:
+        return self._selections[name]
+
+    def __len__(self):
+        return len(self._selections)
+
+    def selections(self) -> List[Selection]:
+        return list(self._selections.values())
+
+    def score(self, name: str) -> float:
+        # The mean of evaluate_selection against the whole league, including 0.5 against itself.
+        return float(self._scores[self._indices[name]])
+
+    def _solve(self, name: str, totals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        index = self._indices[name]
+        others = np.arange(len(self._selections)) != index
+
+        row, col = np.full(len(self._selections), 0.5), np.full(len(self._selections), 0.5)
+        if others.any():
+            other_totals = self._totals[others]
+            probs = batch_next_goal_probs(totals_1=np.broadcast_to(totals, other_totals.shape),
+                                          totals_2=other_totals,
+                                          team_states=self.team_states)
+            row[others], col[others] = probs[:, 0], probs[:, 1]
+        return row, col
+
+    def trial_score(self, name: str, totals: np.ndarray) -> float:
+        # The score that name would have with the given (positions x abilities) totals.
+        row, col = self._solve(name, totals)
+        return float(row.mean())
+
+    def trial_scores(self, name: str, totals: np.ndarray) -> np.ndarray:
+        # trial_score for each of a (candidates x positions x abilities) stack of totals, in one batched solve.
+        index = self._indices[name]
+        others = np.arange(len(self._selections)) != index
+        other_totals = self._totals[others]
+
+        if not others.any():
+            return np.full(len(totals), 0.5)
+
+        shape = (len(totals),) + other_totals.shape
+        probs = batch_next_goal_probs(totals_1=np.broadcast_to(totals[:, np.newaxis], shape),
+                                      totals_2=np.broadcast_to(other_totals, shape),
+                                      team_states=self.team_states)
+        return (probs[..., 0].sum(axis=1) + 0.5) / len(self._selections)
+
+    def update(self, selections: Iterable[Selection]):
+        for selection in selections:
+            if self._selections[selection.name] is selection:
+                continue
+            index = self._indices[selection.name]
+            totals = selection.position_ability_totals()
+            self.matrix[index, :], self.matrix[:, index] = self._solve(selection.name, totals)
+            self._totals[index] = totals
+            self._selections[selection.name] = selection
+        self._scores = self.matrix.mean(axis=1)
+
 
-    for row_index, selection in enumerate(selections):
-        probs = list(evaluate_selection(selection=selection,
-                                        reference_selections=selections,
-                                        team_states=team_states))
-        A[row_index, :] = probs
+def create_next_goal_matrix(selections: List[Selection], team_states: Iterable[TeamState]) -> 'pd.DataFrame':
+    import pandas as pd
+    selections = list(selections)
+    names = [selection.name for selection in selections]
+    n = len(names)
+    A = next_goal_matrix(selections=selections, team_states=team_states)
 
-        mean_probability_other_selection.append(
-            sum([prob for col_index, prob in enumerate(probs) if col_index != row_index]) / (n - 1))
+    mean_probability_other_selection = (A.sum(axis=1) - A.diagonal()) / (n - 1)
 
     frame = pd.DataFrame(data=pd.DataFrame(A, index=names, columns=names))
     frame['mean'] = pd.Series(mean_probability_other_selection, index=frame.index)
@@ -165,31 +462,106 @@ def fixtures(teams: Iterable[str]) -> Iterable[List[str]]:
         dq1.appendleft(start)
 
 
-def hold_fixture(selection_1: Selection, selection_2: Selection):
-    selection_1, selection_2 = optmise_player_positions_in_parrallel(
+@instrument.timed('hold_fixture')
+def hold_fixture(selection_1: Selection, selection_2: Selection,
+                 optimiser: Callable[..., Iterable[Selection]] = optmise_player_positions_in_parrallel,
+                 steps: int = 100,
+                 rng: np.random.Generator = None):
+    rng = np.random.default_rng(rng)
+    selection_1, selection_2 = optimiser(
         selections=(selection_1, selection_2),
-        team_states=[TeamState.WITH_M])
+        team_states=[TeamState.WITH_M],
+        rng=rng)
 
     mc = calculate_markov_chain(selection_1=selection_1, selection_2=selection_2)
 
-    score_keeper = Counter()
-    s = S(selection_1.name, TeamState.WITH_M)
-    for step in range(100):
-        next_s = mc.simulate_next(s)
+    (goals_1, goals_2), = simulate_matches(mc=mc, name_1=selection_1.name, name_2=selection_2.name,
+                                           n_matches=1, steps=steps, rng=rng)
 
-        if next_s == S(selection_1.name, TeamState.SCORED):
-            score_keeper.update([selection_1.name])
-            s = S(selection_2.name, TeamState.WITH_M)
-        elif next_s == S(selection_2.name, TeamState.SCORED):
-            score_keeper.update([selection_2.name])
-            s = S(selection_1.name, TeamState.WITH_M)
-        else:
-            s = next_s
+    score_keeper = Counter()
+    score_keeper[selection_1.name] += int(goals_1)
+    score_keeper[selection_2.name] += int(goals_2)
+    return +score_keeper
+
+
+def simulate_matches(mc: MarkovChain, name_1: str, name_2: str, n_matches: int, steps: int = 100,
+                     rng: np.random.Generator = None) -> np.ndarray:
+    # Samples n_matches independent matches with name_1 kicking off, returning an (n_matches x 2) array of
+    # scorelines.
+    scored_1, scored_2 = S(name_1, TeamState.SCORED), S(name_2, TeamState.SCORED)
+    counts = mc.sample_absorption_counts(s=S(name_1, TeamState.WITH_M),
+                                         steps=steps,
+                                         restarts={scored_1: S(name_2, TeamState.WITH_M),
+                                                   scored_2: S(name_1, TeamState.WITH_M)},
+                                         n_runs=n_matches,
+                                         rng=rng)
+    if mc.absorbing_states.index(scored_1) != 0:
+        counts = counts[:, ::-1]
+    return counts
+
+
+class MatchOutcome(NamedTuple):
+    # scorelines[g1, g2] is the probability that the first club scores g1 and the second club g2.
+    scorelines: np.ndarray
+    win_1: float
+    draw: float
+    win_2: float
+
+    @property
+    def expected_goals(self) -> Tuple[float, float]:
+        goals = np.arange(len(self.scorelines))
+        return (float(goals @ self.scorelines.sum(axis=1)),
+                float(goals @ self.scorelines.sum(axis=0)))
+
+    @property
+    def expected_points(self) -> Tuple[float, float]:
+        return 3.0 * self.win_1 + self.draw, 3.0 * self.win_2 + self.draw
+
+
+def match_outcome(mc: MarkovChain, name_1: str, name_2: str, steps: int = 100) -> MatchOutcome:
+    # The exact distribution of the match that hold_fixture samples, with name_1 kicking off.
+    scored_1, scored_2 = S(name_1, TeamState.SCORED), S(name_2, TeamState.SCORED)
+    counts = mc.absorption_count_distribution(s=S(name_1, TeamState.WITH_M),
+                                              steps=steps,
+                                              restarts={scored_1: S(name_2, TeamState.WITH_M),
+                                                        scored_2: S(name_1, TeamState.WITH_M)})
+    if mc.absorbing_states.index(scored_1) != 0:
+        counts = counts.T
+
+    return MatchOutcome(scorelines=counts,
+                        win_1=float(np.tril(counts, k=-1).sum()),
+                        draw=float(np.trace(counts)),
+                        win_2=float(np.triu(counts, k=1).sum()))
+
+
+def sample_scorelines(outcome: MatchOutcome, n_matches: int, rng: np.random.Generator = None) -> np.ndarray:
+    # Draws n_matches scorelines from the exact distribution, as an (n_matches x 2) array.
+    return scorelines_from_uniforms(outcome=outcome, uniforms=np.random.default_rng(rng).random(n_matches))
+
+
+def scorelines_from_uniforms(outcome: MatchOutcome, uniforms: np.ndarray) -> np.ndarray:
+    # Inverts the cumulative distribution of the scorelines at each of the uniforms.
+    cumulative = np.cumsum(outcome.scorelines.ravel())
+    flat_indices = np.minimum(np.searchsorted(cumulative, uniforms * cumulative[-1], side='right'),
+                              cumulative.size - 1)
+    return np.stack(np.divmod(flat_indices, outcome.scorelines.shape[1]), axis=-1)
+
+
+def hold_expected_fixture(selection_1: Selection, selection_2: Selection,
+                          optimiser: Callable[..., Iterable[Selection]] = optmise_player_positions_in_parrallel,
+                          steps: int = 100,
+                          rng: np.random.Generator = None) -> MatchOutcome:
+    selection_1, selection_2 = optimiser(
+        selections=(selection_1, selection_2),
+        team_states=[TeamState.WITH_M],
+        rng=rng)
 
-    return score_keeper
+    return match_outcome(mc=calculate_markov_chain(selection_1=selection_1, selection_2=selection_2),
+                         name_1=selection_1.name, name_2=selection_2.name, steps=steps)
 
 
 def display_league(lineups_by_name: Dict[str, List[Selection]]):
+    import pandas as pd
     table = create_next_goal_matrix(lineups_by_name.values(), team_states=[TeamState.WITH_M])
     mean_table = table.loc[:, ['mean']]
 
@@ -207,53 +579,180 @@ def display_league(lineups_by_name: Dict[str, List[Selection]]):
     print(mean_table)
 
 
+class ConsoleSink(ResultSink):
+    # The original console report: each fixture with the next goal table and formations of its clubs, and the table
+    # after each week.
+    def emit(self, event: NamedTuple):
+        if isinstance(event, FixtureResult):
+            print('%s vs. %s' % (event.club_1, event.club_2))
+            display_league(lineups_by_name={event.club_1: event.selection_1,
+                                            event.club_2: event.selection_2})
+            print()
+            if event.expected:
+                print('%s: %.2f\t%s: %.2f\t(W %.3f, D %.3f, L %.3f)' % (event.club_1, event.goals_1, event.club_2,
+                                                                       event.goals_2, event.win_1, event.draw,
+                                                                       event.win_2))
+            else:
+                print('%s: %d\t%s: %d' % (event.club_1, event.goals_1, event.club_2, event.goals_2))
+            print()
+            print()
+        elif isinstance(event, WeekTable):
+            print('Table after week %d.' % event.week)
+            print(event.table.to_frame())
+            print()
+
+
+def _play_fixture(selection_1: Selection, selection_2: Selection,
+                  optimiser: Callable[..., Iterable[Selection]], expected: bool, rng: np.random.Generator):
+    # Everything hold_week does for one fixture that does not touch shared state, so it can run in another process.
+    # Given the same rng it replays the fixture exactly.
+    selection_1, selection_2 = optimiser(
+        selections=(selection_1, selection_2),
+        team_states=[TeamState.WITH_M],
+        rng=rng)
+
+    if expected:
+        outcome = hold_expected_fixture(selection_1=selection_1, selection_2=selection_2, optimiser=optimiser,
+                                        rng=rng)
+        goals_1, goals_2 = outcome.expected_goals
+        win_1, draw, win_2 = outcome.win_1, outcome.draw, outcome.win_2
+    else:
+        score_keeper = hold_fixture(selection_1=selection_1, selection_2=selection_2, optimiser=optimiser, rng=rng)
+        goals_1, goals_2 = score_keeper[selection_1.name], score_keeper[selection_2.name]
+        win_1, draw, win_2 = int(goals_1 > goals_2), int(goals_1 == goals_2), int(goals_2 > goals_1)
+
+    return selection_1, selection_2, (goals_1, goals_2, win_1, draw, win_2)
+
+
+def _with_fixture_positions(selection_1: Selection, selection_2: Selection, positions: np.ndarray,
+                            result: Tuple) -> Tuple[Selection, Selection, Tuple]:
+    players = list(selection_1.keys()) + list(selection_2.keys())
+    player_positions = [(player, _positions[position_index])
+                        for player, position_index in zip(players, positions.tolist())]
+    return (selection_1.with_player_positions(player_positions[:len(selection_1)]),
+            selection_2.with_player_positions(player_positions[len(selection_1):]), result)
+
+
+class _FixturePlayers(NamedTuple):
+    # The players of a fixture's two selections as the rows of a PlayerPool of their own, the first sizes[0] rows
+    # for the first club, with the index of each player's position. This is all a fixture sends to another process,
+    # rather than the selections and with them the pool their players come from.
+    names: Tuple[str, str]
+    sizes: Tuple[int, int]
+    ages: np.ndarray
+    first_names: np.ndarray
+    last_names: np.ndarray
+    abilities: np.ndarray
+    positions: np.ndarray
+
+
+def _fixture_players(selection_1: Selection, selection_2: Selection) -> _FixturePlayers:
+    players = list(selection_1.keys()) + list(selection_2.keys())
+    return _FixturePlayers(names=(selection_1.name, selection_2.name),
+                           sizes=(len(selection_1), len(selection_2)),
+                           ages=np.array([player.age for player in players], dtype=np.int16),
+                           first_names=np.array([player.name[0] for player in players], dtype=np.str_),
+                           last_names=np.array([player.name[1] for player in players], dtype=np.str_),
+                           abilities=np.array([player.ability_vector for player in players],
+                                              dtype=np.float32).reshape(-1, len(Ability)),
+                           positions=np.array([position_indices[position]
+                                               for selection in (selection_1, selection_2)
+                                               for position in selection.values()], dtype=np.int8))
+
+
+def _play_fixture_players(fixture_players: _FixturePlayers,
+                          optimiser: Callable[..., Iterable[Selection]], expected: bool,
+                          rng: np.random.Generator) -> Tuple[np.ndarray, Tuple]:
+    # _play_fixture on selections rebuilt from fixture_players, returning the index of each row's new position and
+    # the result.
+    rows = np.arange(len(fixture_players.ages))
+    pool = PlayerPool(ages=fixture_players.ages, first_name_indices=rows, last_name_indices=rows,
+                      abilities=fixture_players.abilities, first_names=fixture_players.first_names,
+                      last_names=fixture_players.last_names)
+    size_1 = fixture_players.sizes[0]
+    selection_1, selection_2 = (Selection(name=name, players=[(pool[row], _positions[fixture_players.positions[row]])
+                                                              for row in club_rows])
+                                for name, club_rows in zip(fixture_players.names, (rows[:size_1], rows[size_1:])))
+
+    selection_1, selection_2, result = _play_fixture(selection_1, selection_2, optimiser=optimiser,
+                                                     expected=expected, rng=rng)
+    new_positions = np.empty_like(fixture_players.positions)
+    for selection in (selection_1, selection_2):
+        for player, position in selection.items():
+            new_positions[player.index] = position_indices[position]
+    return new_positions, result
+
+
+@instrument.timed('hold_week')
 def hold_week(fixtures: List[Tuple[str, str]], selections_by_name: Dict[str, Selection],
               player_position_history: Dict[str, List[Position]], goals: Counter, conceded_goals: Counter,
-              points: Counter, wins: Counter, losses: Counter, draws: Counter):
-    for club_1, club_2 in fixtures:
-        print('%s vs. %s' % (club_1, club_2))
+              points: Counter, wins: Counter, losses: Counter, draws: Counter,
+              optimiser: Callable[..., Iterable[Selection]] = optmise_player_positions_in_parrallel,
+              expected: bool = False,
+              executor: Executor = None,
+              rng: np.random.Generator = None,
+              sink: ResultSink = None,
+              week: int = None):
+    # With expected, each fixture adds its expected goals and points and its W/D/L probabilities to the tables
+    # instead of one sampled scoreline. With an executor, the fixtures of the week, which never share a club, are
+    # optimised and played concurrently. The k-th fixture of the week plays with the k-th child stream spawned from
+    # rng and results are merged in fixture order, so the outcome does not depend on the executor.
+    # Results and lineup changes are sent to sink, in fixture order.
+    report = not is_silent(sink)
+    fixtures = list(fixtures)
+    fixture_rngs = np.random.default_rng(rng).spawn(len(fixtures))
+
+    played = [(club_1, club_2, (selections_by_name[club_1], selections_by_name[club_2], optimiser, expected,
+                                fixture_rng))
+              for (club_1, club_2), fixture_rng in zip(fixtures, fixture_rngs)
+              if club_1 and club_2]
+
+    if executor:
+        # Workers are sent only the fixture's players and return only their positions, which are put back on this
+        # process's own players, so that the selections stay made of players from the pool they came from.
+        futures = [executor.submit(_play_fixture_players, _fixture_players(*args[:2]), *args[2:])
+                   for club_1, club_2, args in played]
+        results = (_with_fixture_positions(*args[:2], *future.result())
+                   for (club_1, club_2, args), future in zip(played, futures))
+    else:
+        results = (_play_fixture(*args) for club_1, club_2, args in played)
+    results = dict(((club_1, club_2), result) for (club_1, club_2, args), result in zip(played, results))
 
+    for club_1, club_2 in fixtures:
         if not club_1 or not club_2:
             continue
 
-        selection_1 = selections_by_name[club_1]
-        selection_2 = selections_by_name[club_2]
-
-        selection_1, selection_2 = optmise_player_positions_in_parrallel(
-            selections=(selection_1, selection_2),
-            team_states=[TeamState.WITH_M])
+        selection_1, selection_2, (goals_1, goals_2, win_1, draw, win_2) = results[(club_1, club_2)]
 
         for selection in [selection_1, selection_2]:
             for player, position in selection.items():
                 player_position_history[player.name].append(position)
 
+            if report:
+                previous = selections_by_name[selection.name]
+                for player, position in selection.items():
+                    if previous.get(player) != position:
+                        sink.emit(LineupChange(week=week, club=selection.name, player=player.name,
+                                               from_position=previous.get(player), to_position=position))
+
         selections_by_name[club_1] = selection_1
         selections_by_name[club_2] = selection_2
 
-        display_league(lineups_by_name={club_1: selection_1,
-                                        club_2: selection_2})
-
-        score_keeper = hold_fixture(selection_1=selection_1, selection_2=selection_2)
-
-        goals.update(score_keeper)
-        conceded_goals[club_1] += score_keeper[club_2]
-        conceded_goals[club_2] += score_keeper[club_1]
-
-        if score_keeper[club_1] > score_keeper[club_2]:
-            points[club_1] += 3
-            wins[club_1] += 1
-            losses[club_2] += 1
-        elif score_keeper[club_2] > score_keeper[club_1]:
-            points[club_2] += 3
-            wins[club_2] += 1
-            losses[club_1] += 1
-        else:
-            points[club_1] += 1
-            points[club_2] += 1
-            draws[club_1] += 1
-            draws[club_2] += 1
-
-        print()
-        print('%s: %d\t%s: %d' % (club_1, score_keeper[club_1], club_2, score_keeper[club_2]))
-        print()
-        print()
+        goals[club_1] += goals_1
+        goals[club_2] += goals_2
+        conceded_goals[club_1] += goals_2
+        conceded_goals[club_2] += goals_1
+
+        points[club_1] += 3 * win_1 + draw
+        points[club_2] += 3 * win_2 + draw
+        wins[club_1] += win_1
+        wins[club_2] += win_2
+        losses[club_1] += win_2
+        losses[club_2] += win_1
+        draws[club_1] += draw
+        draws[club_2] += draw
+
+        if report:
+            sink.emit(FixtureResult(week=week, club_1=club_1, club_2=club_2, selection_1=selection_1,
+                                    selection_2=selection_2, goals_1=goals_1, goals_2=goals_2, win_1=win_1, draw=draw,
+                                    win_2=win_2, expected=expected))
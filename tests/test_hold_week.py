@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+from markov_football.league import (create_population, create_selections, play_season, load_season_state,
+                                    save_season_state)
+from markov_football.sink import ResultSink
+import numpy as np
+import pytest
+
+
+class ListSink(ResultSink):
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+def play(executor, path, pool, names, expected):
+    sink = ListSink()
+    table = play_season(create_selections(names, pool), expected=expected, executor=executor,
+                        rng=np.random.default_rng(7), checkpoint=lambda state: save_season_state(path, state, pool),
+                        sink=sink)
+    return table, sink.events, load_season_state(path, pool)
+
+
+def summary(event):
+    # Events compared by what they report rather than by the identity of the players in them.
+    if hasattr(event, 'selection_1'):
+        return event._replace(selection_1=sorted((player.name, position.name)
+                                                 for player, position in event.selection_1.items()),
+                              selection_2=sorted((player.name, position.name)
+                                                 for player, position in event.selection_2.items()))
+    if hasattr(event, 'table'):
+        return event.week, [np.asarray(column).tolist() for column in event.table]
+    return event
+
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_season_on_a_process_pool_matches_serial_season(tmp_path, expected):
+    names = ['a', 'b', 'c', 'd']
+    pool = create_population({'League': names}, rng=np.random.default_rng(1))
+
+    serial_table, serial_events, serial_state = play(None, str(tmp_path / 'serial.npz'), pool, names, expected)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        table, events, state = play(executor, str(tmp_path / 'parallel.npz'), pool, names, expected)
+
+    for column_1, column_2 in zip(table, serial_table):
+        np.testing.assert_array_equal(np.asarray(column_1), np.asarray(column_2))
+    assert [summary(event) for event in events] == [summary(event) for event in serial_events]
+    assert state.week == serial_state.week
+    assert state.selections_by_name == serial_state.selections_by_name
+    assert dict(state.player_position_history) == dict(serial_state.player_position_history)
@@ -0,0 +1,34 @@
+from markov_football.league import (create_population, create_selections, play_season, load_season_state,
+                                    save_season_state)
+import numpy as np
+import pytest
+
+
+class Stop(Exception):
+    pass
+
+
+@pytest.mark.parametrize('expected', [False, True])
+def test_resumed_season_matches_uninterrupted_season(tmp_path, expected):
+    names = ['a', 'b', 'c', 'd']
+    pool = create_population({'League': names}, rng=np.random.default_rng(1))
+    path = str(tmp_path / 'season.npz')
+
+    uninterrupted = play_season(create_selections(names, pool), expected=expected, rng=np.random.default_rng(7))
+
+    def stop_after_first_week(state):
+        save_season_state(path, state, pool)
+        raise Stop
+
+    with pytest.raises(Stop):
+        play_season(create_selections(names, pool), expected=expected, rng=np.random.default_rng(7),
+                    checkpoint=stop_after_first_week)
+    state = load_season_state(path, pool)
+    assert state.week == 1
+    resumed = play_season(state.selections_by_name, expected=expected, resume_from=state)
+
+    assert resumed.names == uninterrupted.names
+    for column in ('points', 'wins', 'draws', 'losses', 'goals', 'conceded_goals'):
+        np.testing.assert_array_equal(getattr(resumed, column), getattr(uninterrupted, column))
+    if expected:
+        assert resumed.points.dtype == np.float64
@@ -0,0 +1,60 @@
+from markov_football.markov import MarkovChain, SparseMarkovChain, Tx
+import numpy as np
+
+
+def random_walk(n: int):
+    # A walk between two absorbing ends, which mixes slowly: I - Q has a condition number of order n^2.
+    return [Tx(i, i + step, 1.0) for i in range(1, n - 1) for step in (-1, 1)]
+
+
+def test_sparse_matches_dense_on_a_slow_mixing_chain():
+    transitions = random_walk(1000)
+    sparse = MarkovChain(transitions)
+    dense = MarkovChain(transitions, sparse=False)
+    assert isinstance(sparse, SparseMarkovChain)
+
+    states = [1, 250, 500, 998]
+    expected = np.array([[1 - s / 999, s / 999] for s in states])
+    np.testing.assert_allclose(dense.absorption_probabilities_given_states(states), expected, atol=1e-9)
+    np.testing.assert_allclose(sparse.absorption_probabilities_given_states(states), expected, atol=1e-9)
+
+
+def test_sparse_matches_dense_on_a_random_chain():
+    rng = np.random.default_rng(0)
+    n = 600
+    transitions = [Tx(i, int(j), float(w)) for i in range(n) for j, w in
+                   zip(rng.choice(n + 3, size=4, replace=False), rng.random(4) + 0.1) if j != i]
+    sparse = MarkovChain(transitions, sparse=True)
+    dense = MarkovChain(transitions, sparse=False)
+    assert sparse.states == dense.states
+
+    np.testing.assert_allclose(sparse.B, dense.B, atol=1e-9)
+    states = list(sparse.transient_states[:20])
+    np.testing.assert_allclose(sparse.absorption_probabilities_given_states(states),
+                               dense.absorption_probabilities_given_states(states), atol=1e-9)
+
+
+def test_sparse_samples_as_dense_does_with_a_hub_state():
+    # State 0 reaches every other state, as a kick-off spread over all pitch zones would.
+    n = 800
+    transitions = ([Tx(0, i, 1.0 + i % 7) for i in range(1, n)] +
+                   [Tx(i, i + 1, 2.0) for i in range(1, n - 1)] + [Tx(i, 0, 1.0) for i in range(1, n - 1)])
+    sparse = MarkovChain(transitions)
+    dense = MarkovChain(transitions, sparse=False)
+    assert isinstance(sparse, SparseMarkovChain)
+
+    rng = np.random.default_rng(1)
+    indices = rng.integers(len(sparse.transient_states), size=5000)
+    u = rng.random(5000)
+    np.testing.assert_array_equal(sparse._sample_next_indices(indices, u), dense._sample_next_indices(indices, u))
+    assert sparse._sampling.shape == sparse.transition_csr.data.shape
+
+
+def test_sparse_from_transition_matrix():
+    dense = MarkovChain(random_walk(50), sparse=False)
+    sparse = SparseMarkovChain.from_transition_matrix(transient_states=dense.transient_states,
+                                                      absorbing_states=dense.absorbing_states,
+                                                      transition_matrix=dense.transition_matrix)
+    assert isinstance(sparse, SparseMarkovChain)
+    np.testing.assert_array_equal(sparse.transition_matrix, dense.transition_matrix)
+    np.testing.assert_allclose(sparse.B, dense.B, atol=1e-12)
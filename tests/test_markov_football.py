@@ -0,0 +1,24 @@
+from markov_football.league import create_population, create_selections
+from markov_football.markov_football import NextGoalCache, Position, Selection, TeamState
+import numpy as np
+
+
+def test_next_goal_cache_ignores_the_bench():
+    names = ['a', 'b']
+    pool = create_population({'League': names}, rng=np.random.default_rng(0))
+    selection_1, selection_2 = create_selections(names, pool).values()
+    bench = [player for player, position in selection_1.items() if position is Position.B]
+    assert bench
+    without_bench_player = Selection(name=selection_1.name,
+                                     players=[(player, position) for player, position in selection_1.items()
+                                              if player is not bench[0]])
+    team_states = [TeamState.WITH_M]
+
+    cache = NextGoalCache()
+    probs = cache.next_goal_probs(selection_1.position_ability_totals(), selection_2.position_ability_totals(),
+                                  team_states=team_states)
+    probs_without_bench_player = cache.next_goal_probs(without_bench_player.position_ability_totals(),
+                                                       selection_2.position_ability_totals(), team_states=team_states)
+
+    np.testing.assert_array_equal(probs_without_bench_player, probs)
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,14 @@
+from markov_football.league import create_population, create_selections
+from markov_football.season import simulate_seasons
+import numpy as np
+
+
+def test_full_ties_are_broken_at_random():
+    # With no steps played every match is 0-0, so every club is level on points, goal difference and goals in
+    # every replica, and only the tie-break orders them.
+    names = ['a', 'b', 'c', 'd']
+    pool = create_population({'League': names}, rng=np.random.default_rng(0))
+    summary = simulate_seasons(create_selections(names, pool), replicas=4000, relegation_places=1, steps=0,
+                               rng=np.random.default_rng(3))
+    np.testing.assert_allclose(summary.title_probability, 0.25, atol=0.03)
+    np.testing.assert_allclose(summary.relegation_probability, 0.25, atol=0.03)
@@ -0,0 +1,36 @@
+from markov_football.league import LeagueTable
+from markov_football.sink import CsvSink, WeekTable
+from collections import Counter
+import pytest
+import threading
+import time
+
+
+class FullDiskWriter(object):
+    # Fails only once the emitting thread has had time to fill the queue.
+    def writerows(self, rows):
+        time.sleep(0.2)
+        raise OSError(28, 'No space left on device')
+
+
+def test_csv_sink_raises_rather_than_hangs_after_a_failed_write(tmp_path):
+    sink = CsvSink(str(tmp_path), max_queued=2)
+    sink._writers[WeekTable] = FullDiskWriter()
+    table = LeagueTable.from_counters(['a', 'b'], Counter(), Counter(), Counter(), Counter(), Counter(), Counter())
+    raised = []
+
+    def emit_many():
+        try:
+            for week in range(100):
+                sink.emit(WeekTable(week=week, table=table))
+        except RuntimeError as error:
+            raised.append(error)
+
+    thread = threading.Thread(target=emit_many, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert isinstance(raised[0].__cause__, OSError)
+
+    with pytest.raises(RuntimeError):
+        sink.close()
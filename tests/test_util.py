@@ -0,0 +1,21 @@
+from markov_football.league import create_population, create_selections
+from markov_football.markov_football import Selection, TeamState
+from markov_football.util import evaluate_selection, selection_sensitivities
+import numpy as np
+
+
+def test_a_selection_is_recognised_by_an_equal_name():
+    names = ['a', 'b', 'c']
+    pool = create_population({'League': names}, rng=np.random.default_rng(0))
+    selections = list(create_selections(names, pool).values())
+    # An equal name that is a different string object, as one loaded from a store would be.
+    renamed = Selection(name=''.join(['', 'a']), players=list(selections[0].items()))
+    assert renamed.name is not selections[0].name
+    team_states = [TeamState.WITH_M]
+
+    scores = list(evaluate_selection(renamed, selections, team_states=team_states))
+    assert scores[0] == 0.5
+    assert scores[1:] == list(evaluate_selection(selections[0], selections, team_states=team_states))[1:]
+
+    sensitivities = selection_sensitivities(renamed, selections, team_states=team_states)
+    assert sensitivities.score == np.mean(scores[1:])